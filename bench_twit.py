@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""Benchmarks for Twit on synthetic repositories.
+
+Generates repositories at several scales, times the hot repository
+operations, counts the git processes each one starts, and optionally
+compares the results against a stored baseline.
+
+    python bench_twit.py --scale small --scale medium
+    python bench_twit.py --scale medium --save-baseline bench_baseline.json
+    python bench_twit.py --scale medium --baseline bench_baseline.json
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import twit
+
+# name: (files, snapshots, branches)
+SCALES = {
+    'tiny': (10, 10, 1),
+    'small': (1000, 100, 10),
+    'medium': (10000, 1000, 100),
+    'large': (100000, 10000, 1000),
+}
+
+FILES_PER_DIR = 100
+
+BACKENDS = {
+    'git': twit.GitExeTwitRepo,
+    'pygit2': twit.Pygit2TwitRepo,
+}
+
+
+def _git(workdir, *args, **kwargs):
+    """Run git for repository setup, outside of the measured hooks."""
+    return subprocess.check_output(('git',) + args, cwd=workdir,
+                                   **kwargs).decode().strip()
+
+
+def _fast_import(workdir, stream):
+    proc = subprocess.Popen(('git', 'fast-import', '--quiet'), cwd=workdir,
+                            stdin=subprocess.PIPE)
+    proc.communicate(stream.encode())
+    if proc.returncode:
+        raise RuntimeError('git fast-import failed')
+
+
+def generate_repo(path, files, snapshots, branches):
+    """Create a repository with the given numbers of files, snapshots and
+    branches, all sharing one base commit."""
+    _git(path, 'init', '-q')
+    _git(path, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+    _git(path, 'config', 'user.name', 'Twit Bench')
+    _git(path, 'config', 'user.email', 'bench@example.com')
+    for index in range(files):
+        dirname = os.path.join(path, 'dir{}'.format(index // FILES_PER_DIR))
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+        with open(os.path.join(dirname, 'file{}.txt'.format(index)),
+                  'w') as wfile:
+            wfile.write('line {}\n'.format(index))
+    _git(path, 'add', '--all', '.')
+    _git(path, 'commit', '-q', '-m', 'Initial commit')
+    head = _git(path, 'rev-parse', 'HEAD')
+
+    # Snapshots are written through fast-import, which is much quicker than
+    # calling save() thousands of times.
+    stream = []
+    for index in range(1, snapshots + 1):
+        message = twit._snapshot_message('master')
+        stream.append(
+            'commit {prefix}{index}\n'
+            'committer Twit Bench <bench@example.com> {time} +0000\n'
+            'data {size}\n{message}\n'
+            'from {head}\n\n'.format(
+                prefix=twit.SNAPSHOT_PREFIX, index=index,
+                time=1500000000 + index, size=len(message), message=message,
+                head=head))
+    for index in range(1, branches):
+        stream.append('reset refs/heads/bench/{}\nfrom {}\n\n'.format(
+            index, head))
+    if stream:
+        _fast_import(path, ''.join(stream))
+    _git(path, 'reset', '-q', '--hard', 'HEAD')
+    return path
+
+
+def _touch(workdir, count=3):
+    """Modify a few tracked files and add an untracked one."""
+    for index in range(count):
+        with open(os.path.join(workdir, 'dir0',
+                               'file{}.txt'.format(index)), 'a') as wfile:
+            wfile.write('changed\n')
+    with open(os.path.join(workdir, 'untracked.txt'), 'w') as wfile:
+        wfile.write('new\n')
+
+
+def _reset(workdir):
+    """Return the repository to a clean checkout of its main branch."""
+    _git(workdir, 'checkout', '-q', '-f', 'master')
+    _git(workdir, 'clean', '-q', '-f', '-d')
+
+
+def _latest_snapshot(repo):
+    return max(repo.snapshots,
+               key=lambda ref: int(ref[len(twit.SNAPSHOT_PREFIX):]))
+
+
+# name: (setup(workdir, repo), operation(repo))
+OPERATIONS = [
+    ('dirty', lambda workdir, repo: _touch(workdir),
+     lambda repo: repo.dirty),
+    ('save', lambda workdir, repo: _touch(workdir),
+     lambda repo: repo.save()),
+    ('snapshots', None,
+     lambda repo: list(repo.snapshot_infos())),
+    ('open', lambda workdir, repo: _reset(workdir),
+     lambda repo: repo.open('bench/1' if repo.rev_parse('bench/1')
+                            else 'master')),
+    ('open_snapshot', lambda workdir, repo: _reset(workdir),
+     lambda repo: repo.open_snapshot(_latest_snapshot(repo))),
+    ('discard_all', lambda workdir, repo: _touch(workdir),
+     lambda repo: repo.discard_all()),
+]
+
+
+def measure(repo, workdir, setup, operation, repeat):
+    """Time an operation, returning the best run and its git process count."""
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup(workdir, repo)
+        with twit.GitProfiler() as profiler:
+            operation(repo)
+        summary = profiler.summary()
+        if best is None or summary['wall_ms'] < best['wall_ms']:
+            best = {
+                'wall_ms': round(summary['wall_ms'], 3),
+                'git_processes': summary['git_processes'],
+                'git_calls': summary['git_calls'],
+            }
+    return best
+
+
+def run_benchmarks(scales, repeat=3, backend='git', operations=None,
+                   progress=None):
+    """Run the benchmarks, returning ``{scale: {operation: result}}``."""
+    repo_class = BACKENDS[backend]
+    results = {}
+    for scale in scales:
+        files, snapshots, branches = SCALES[scale] \
+            if isinstance(scale, str) else scale
+        name = scale if isinstance(scale, str) else '{}x{}x{}'.format(*scale)
+        workdir = tempfile.mkdtemp(prefix='twit-bench-')
+        try:
+            generate_repo(workdir, files, snapshots, branches)
+            results[name] = {}
+            with repo_class.from_path(workdir) as repo:
+                for op_name, setup, operation in OPERATIONS:
+                    if operations and op_name not in operations:
+                        continue
+                    _reset(workdir)
+                    result = measure(repo, workdir, setup, operation, repeat)
+                    results[name][op_name] = result
+                    if progress is not None:
+                        progress(name, op_name, result)
+        finally:
+            shutil.rmtree(workdir)
+    return results
+
+
+def compare(results, baseline, tolerance=1.5):
+    """Return descriptions of results that regressed against a baseline.
+
+    An operation regresses when it is more than ``tolerance`` times slower,
+    or starts more git processes, than its baseline.
+    """
+    regressions = []
+    for scale, operations in sorted(results.items()):
+        for op_name, result in sorted(operations.items()):
+            base = baseline.get(scale, {}).get(op_name)
+            if base is None:
+                continue
+            if result['wall_ms'] > base['wall_ms'] * tolerance:
+                regressions.append(
+                    '{} {}: {:.1f} ms, baseline {:.1f} ms'.format(
+                        scale, op_name, result['wall_ms'], base['wall_ms']))
+            if result['git_processes'] > base['git_processes']:
+                regressions.append(
+                    '{} {}: {} git processes, baseline {}'.format(
+                        scale, op_name, result['git_processes'],
+                        base['git_processes']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', action='append', choices=sorted(SCALES),
+                        help='repository scale to run (repeatable)')
+    parser.add_argument('--operation', action='append',
+                        choices=[name for name, _, _ in OPERATIONS],
+                        help='operation to run (repeatable, default all)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='git')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write results as JSON to a file')
+    parser.add_argument('--baseline', help='compare against a baseline file')
+    parser.add_argument('--save-baseline', help='write results as a baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='allowed slowdown factor against the baseline')
+    args = parser.parse_args(argv)
+
+    def progress(scale, op_name, result):
+        print('{:<8} {:<14} {:>10.1f} ms {:>6} git processes'.format(
+            scale, op_name, result['wall_ms'], result['git_processes']))
+        sys.stdout.flush()
+
+    results = run_benchmarks(args.scale or ['tiny'], repeat=args.repeat,
+                             backend=args.backend, operations=args.operation,
+                             progress=progress)
+    for filename in (args.output, args.save_baseline):
+        if filename:
+            with open(filename, 'w') as wfile:
+                json.dump(results, wfile, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as rfile:
+            regressions = compare(results, json.load(rfile), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
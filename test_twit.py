@@ -1,18 +1,45 @@
+import io
 import os
 import re
 import sys
+import json
+import time
+import errno
 import shutil
+import socket
 import tempfile
 import unittest
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
 
-from twit import (GitExeTwitRepo, DetachedHead, DirtyWorkTree, InvalidRef, _cd,
-        _git)
+from click.testing import CliRunner
+
+import twit
+import twit_cli
+import bench_twit
+from twit import (GitExeTwitRepo, Pygit2TwitRepo, DetachedHead, DirtyWorkTree,
+        GitError, InvalidRef, RefInfo, PYGIT2, _git, _LRUCache)
 
 PY2 = sys.version_info[0] == 2
 PY3 = sys.version_info[0] == 3
 
-class SharedTestMixin(object):
-    """Mixin to test both GitRepo backends."""
+if not PY2:
+    import asyncio
+    from twit_async import AsyncTwitRepo
+
+class _cd(object):
+    """Context manager to temporarily change directory."""
+    def __init__(self, path):
+        self.path = path
+    def __enter__(self):
+        self.old_cwd = os.getcwd()
+        os.chdir(self.path)
+    def __exit__(self, type_, value, traceback):
+        os.chdir(self.old_cwd)
+
+class TempRepoMixin(object):
+    """Helpers for tests that run inside a temporary repository."""
 
     if not PY2:
         # renamed in Python 3
@@ -52,6 +79,9 @@ class SharedTestMixin(object):
         for line in status.split('\0'):
             self.assertEqual(line[1], ' ')
 
+class SharedTestMixin(TempRepoMixin):
+    """Mixin to test both GitRepo backends."""
+
     def test_current_branch(self):
         self.assertEqual('master', self.repo.current_branch)
         _git('checkout', '-b', 'newbranch')
@@ -88,6 +118,27 @@ class SharedTestMixin(object):
         self.assertItemsEqual(['refs/heads/master', 'refs/heads/newbranch',
             'refs/tags/v1.0'], self.repo.refs)
 
+    def test_packed_refs(self):
+        self.commit_file('README')
+        commit1 = _git('rev-parse', 'HEAD')
+        _git('branch', 'newbranch')
+        _git('tag', 'v1.0')
+        _git('pack-refs', '--all')
+        self.assertItemsEqual(['refs/heads/master', 'refs/heads/newbranch',
+            'refs/tags/v1.0'], self.repo.refs)
+        self.assertEqual(commit1, self.repo.rev_parse('newbranch'))
+        self.assertEqual(commit1, self.repo.rev_parse('v1.0'))
+        self.commit_file('file2')
+        commit2 = _git('rev-parse', 'HEAD')
+        self.assertEqual(commit2, self.repo.rev_parse('master'))
+        self.assertEqual(commit1, self.repo.rev_parse('newbranch'))
+        _git('branch', '-D', 'newbranch')
+        self.assertEqual('', self.repo.rev_parse('newbranch'))
+        self.assertItemsEqual(['refs/heads/master', 'refs/tags/v1.0'],
+                self.repo.refs)
+        _git('symbolic-ref', 'refs/heads/alias', 'refs/heads/master')
+        self.assertEqual(commit2, self.repo.rev_parse('alias'))
+
     def test_branches(self):
         self.commit_file('README')
         self.assertItemsEqual(['master'], self.repo.branches)
@@ -112,6 +163,17 @@ class SharedTestMixin(object):
         self.write_file('new_file', 'new')
         self.assertTrue(self.repo.dirty)
 
+    def test_is_dirty(self):
+        self.commit_file('README', 'original')
+        self.commit_file('other', 'original')
+        self.write_file('new_file', 'new')
+        self.assertTrue(self.repo.is_dirty())
+        self.assertFalse(self.repo.is_dirty(untracked=False))
+        _git('mv', 'other', 'renamed')
+        self.assertFalse(self.repo.is_dirty(untracked=False))
+        self.write_file('README', 'changed')
+        self.assertTrue(self.repo.is_dirty(untracked=False))
+
     def test_stage_all(self):
         self.commit_file('README', 'original')
         self.commit_file('mistake', 'oops')
@@ -163,6 +225,23 @@ class SharedTestMixin(object):
             contents = rfile.read()
         self.assertEqual(contents, 'original')
 
+    def test_discard_all_unborn(self):
+        self.assertEqual((0, 0), self.repo.discard_all())
+        os.makedirs(os.path.join('a', 'b'))
+        os.mkdir('kept')
+        self.write_file(os.path.join('a', 'b', 'file1'))
+        self.write_file(os.path.join('a', 'file2'))
+        self.write_file(os.path.join('kept', 'ignored'))
+        self.write_file(os.path.join('.git', 'info', 'exclude'), 'ignored\n')
+        self.write_file('file3')
+        _git('add', 'a', 'file3')
+        self.write_file('file3', 'changed')
+        self.assertEqual((3, 2), self.repo.discard_all())
+        self.assertItemsEqual(['.git', 'kept'], os.listdir('.'))
+        self.assertEqual(['ignored'], os.listdir('kept'))
+        self.assertEqual('', _git('ls-files'))
+        self.assertFalse(self.repo.dirty)
+
     def test_safe_checkout(self):
         self.commit_file('file1', 'foo')
         commit1 = _git('rev-parse', 'HEAD')
@@ -210,6 +289,10 @@ class SharedTestMixin(object):
         self.assertEqual(commit1, self.repo.rev_parse('master'))
         self.assertEqual('', self.repo.rev_parse('foo'))
         self.assertEqual('', self.repo.rev_parse('HEAD^'))
+        self.commit_file('file2', 'bar')
+        commit2 = _git('rev-parse', 'HEAD')
+        self.assertEqual(commit2, self.repo.rev_parse('HEAD'))
+        self.assertEqual(commit1, self.repo.rev_parse('HEAD^'))
 
     def test_commit_info(self):
         self.write_file('file1', 'foo')
@@ -224,6 +307,37 @@ class SharedTestMixin(object):
         info2 = self.repo.commit_info('HEAD')
         self.assertEqual(info2.message.rstrip(), 'anothr message')
         self.assertEqual([commit1], info2.parents)
+        info1 = self.repo.commit_info(commit1)
+        self.assertEqual(info1.message.rstrip(), 'my message')
+        self.assertEqual([], info1.parents)
+        with self.assertRaises(InvalidRef):
+            self.repo.commit_info('foo')
+
+    def test_commit_info_cache(self):
+        self.commit_file('file1', 'foo')
+        info = self.repo.commit_info('HEAD')
+        self.assertIs(info, self.repo.commit_info('master'))
+        repo = self.repo.__class__.from_cwd(persist_commits=True)
+        try:
+            self.assertEqual(info, repo.commit_info('HEAD'))
+        finally:
+            repo.close()
+        oid = _git('rev-parse', 'HEAD')
+        cached = os.path.join(self.repo.path, 'twit', 'commits', oid[:2],
+                              oid[2:])
+        self.assertTrue(os.path.exists(cached))
+        os.environ['TWIT_COMMIT_CACHE'] = '1'
+        try:
+            repo = self.repo.__class__.from_cwd()
+        finally:
+            del os.environ['TWIT_COMMIT_CACHE']
+        try:
+            self.assertIsNotNone(repo._commit_store)
+            stored = repo.commit_info('HEAD')
+            self.assertEqual(info, stored)
+            self.assertEqual(1, len(set([info, stored])))
+        finally:
+            repo.close()
 
     def test_save(self):
         self.write_file('file1')
@@ -233,6 +347,292 @@ class SharedTestMixin(object):
         ref_folders = [os.path.dirname(ref) for ref in refs]
         self.assertIn('refs/hidden/tags/twit', ref_folders)
 
+    def test_save_keeps_index(self):
+        self.commit_file('file1', 'original')
+        self.write_file('file1', 'staged')
+        _git('add', 'file1')
+        self.write_file('file1', 'unstaged')
+        self.write_file('file2')
+        status = _git('status', '-z')
+        with open(os.path.join(self.repo.path, 'index'), 'rb') as rfile:
+            index = rfile.read()
+        snapshot = self.repo.save()
+        with open(os.path.join(self.repo.path, 'index'), 'rb') as rfile:
+            self.assertEqual(index, rfile.read())
+        self.assertEqual(status, _git('status', '-z'))
+        self.assertEqual('unstaged', _git('show', snapshot + ':file1'))
+        self.assertEqual('Read me.', _git('show', snapshot + ':file2'))
+        self.assertEqual([], [name for name in os.listdir(self.repo.path)
+                              if name.startswith('twit-index-')])
+
+    def test_save_numbering(self):
+        self.commit_file('file1')
+        snapshot1 = self.repo.save()
+        self.write_file('file2', '2')
+        snapshot2 = self.repo.save()
+        self.assertEqual('refs/hidden/tags/twit/1', snapshot1)
+        self.assertEqual('refs/hidden/tags/twit/2', snapshot2)
+        # A stale counter must not overwrite an existing snapshot.
+        with open(os.path.join(self.repo.path, 'twit', 'next-snapshot'),
+                  'w') as wfile:
+            wfile.write('1\n')
+        self.write_file('file2', '3')
+        snapshot3 = self.repo.save()
+        self.assertEqual('refs/hidden/tags/twit/3', snapshot3)
+        os.remove(os.path.join(self.repo.path, 'twit', 'next-snapshot'))
+        self.write_file('file2', '4')
+        self.assertEqual('refs/hidden/tags/twit/4', self.repo.save())
+        # Failures other than an existing ref must not be retried forever.
+        with open(os.path.join(self.repo.path, 'twit', 'next-snapshot'),
+                  'w') as wfile:
+            wfile.write('bad/name\n')
+        _git('update-ref', 'refs/hidden/tags/twit/5/blocker', 'HEAD')
+        self.write_file('file2', '5')
+        with self.assertRaises(GitError):
+            self.repo.save()
+
+    def test_save_skips_duplicates(self):
+        self.commit_file('file1')
+        self.write_file('file2', 'a')
+        snapshot1 = self.repo.save()
+        self.assertEqual(snapshot1, self.repo.save())
+        self.write_file('file2', 'b')
+        snapshot2 = self.repo.save()
+        self.assertNotEqual(snapshot1, snapshot2)
+        # Only the latest snapshot is compared against.
+        self.write_file('file2', 'a')
+        snapshot3 = self.repo.save()
+        self.assertNotIn(snapshot3, (snapshot1, snapshot2))
+        _git('checkout', '-q', '-b', 'other')
+        snapshot4 = self.repo.save()
+        self.assertNotEqual(snapshot3, snapshot4)
+        self.assertEqual(snapshot4, self.repo.save())
+        self.assertEqual(4, len(self.repo.snapshots))
+
+    def test_snapshot_infos(self):
+        self.assertEqual([], list(self.repo.snapshot_infos()))
+        self.write_file('file1')
+        snapshot1 = self.repo.save()
+        self.write_file('file2')
+        snapshot2 = self.repo.save()
+        infos = list(self.repo.snapshot_infos())
+        self.assertItemsEqual([snapshot1, snapshot2],
+                [info.ref for info in infos])
+        for info in infos:
+            self.assertEqual(self.repo.rev_parse(info.ref), info.oid)
+            self.assertEqual(self.repo.commit_info(info.oid).time, info.time)
+        self.assertEqual(1, len(list(self.repo.snapshot_infos(limit=1))))
+        self.assertEqual([], list(self.repo.snapshot_infos(
+            since=infos[0].time + 1)))
+
+    def test_snapshot_index(self):
+        self.assertEqual({}, self.repo.snapshot_index())
+        self.write_file('file1')
+        snapshot1 = self.repo.save()
+        self.commit_file('file2')
+        snapshot2 = self.repo.save()
+        oid1 = _git('rev-parse', snapshot1)
+        oid2 = _git('rev-parse', snapshot2)
+        self.assertEqual({oid1: snapshot1, oid2: snapshot2},
+                self.repo.snapshot_index())
+        self.assertEqual(set([oid1, oid2]), self.repo.snapshot_commits)
+        os.remove('file1')
+        with self.assertRaises(InvalidRef):
+            self.repo.open_snapshot('master')
+
+    def test_ref_transaction(self):
+        self.commit_file('file1')
+        head = self.repo.rev_parse('HEAD')
+        with self.repo.ref_transaction() as transaction:
+            transaction.create('refs/heads/a', head)
+            transaction.create('refs/heads/b', head)
+            self.assertEqual(2, len(transaction))
+            self.assertEqual('', self.repo.rev_parse('refs/heads/a'))
+        self.assertEqual(head, self.repo.rev_parse('refs/heads/b'))
+        transaction = self.repo.ref_transaction()
+        transaction.delete('refs/heads/a', head)
+        transaction.create('refs/heads/b', head)
+        with self.assertRaises(GitError) as context:
+            transaction.commit()
+        self.assertIn('refs/heads/b', str(context.exception))
+        self.assertEqual(head, self.repo.rev_parse('refs/heads/a'))
+        with self.assertRaises(ValueError):
+            with self.repo.ref_transaction() as transaction:
+                transaction.delete('refs/heads/a')
+                raise ValueError
+        self.assertEqual(head, self.repo.rev_parse('refs/heads/a'))
+        with self.repo.ref_transaction() as transaction:
+            transaction.verify('refs/heads/c')
+            transaction.verify('refs/heads/b', head)
+            transaction.delete('refs/heads/a')
+        self.assertEqual('', self.repo.rev_parse('refs/heads/a'))
+
+    def test_prune_snapshots(self):
+        snapshots = []
+        for content in 'abc':
+            self.write_file('file1', content)
+            snapshots.append(self.repo.save())
+        with self.assertRaises(ValueError):
+            self.repo.prune_snapshots()
+        newest = snapshots[-1]
+        doomed = self.repo.prune_snapshots(keep_last=1, dry_run=True)
+        self.assertEqual(2, len(doomed))
+        self.assertEqual(3, len(self.repo.snapshots))
+        kept = [info.ref for info in self.repo.snapshot_infos(limit=1)]
+        self.assertItemsEqual(doomed, self.repo.prune_snapshots(keep_last=1))
+        self.assertEqual(kept, self.repo.snapshots)
+        with io.open(os.path.join('.git', 'packed-refs')) as rfile:
+            self.assertIn(kept[0], rfile.read())
+        self.assertEqual(newest, self.repo.save())
+        self.write_file('file1', 'd')
+        self.assertNotEqual(newest, self.repo.save())
+        self.assertEqual(2, len(self.repo.snapshots))
+
+    def test_export_import_snapshots(self):
+        snapshots = []
+        for content in 'ab':
+            self.write_file('file1', content)
+            snapshots.append(self.repo.save())
+        other = tempfile.mkdtemp()
+        bundles = tempfile.mkdtemp()
+        full = os.path.join(bundles, 'full.bundle')
+        incremental = os.path.join(bundles, 'incremental.bundle')
+        try:
+            self.assertItemsEqual(snapshots,
+                                  self.repo.export_snapshots(full))
+            self.assertEqual([], self.repo.export_snapshots(incremental,
+                                                            since=[full]))
+            self.assertFalse(os.path.exists(incremental))
+            with _cd(other):
+                _git('init')
+                self.write_file('other_file')
+                other_repo = self.repo.__class__.from_cwd()
+                other_snapshot = other_repo.save()
+            try:
+                # A stale counter makes the first numbering collide.
+                twit._write_snapshot_counter(other_repo._refs.common_path, 1)
+                imported = other_repo.import_snapshots(full)
+                self.assertEqual(2, len(imported))
+                self.assertNotIn(other_snapshot, imported)
+                self.assertEqual(
+                    [self.repo.rev_parse(ref) for ref in snapshots],
+                    [other_repo.rev_parse(ref) for ref in imported])
+                self.assertEqual([], other_repo.import_snapshots(full))
+
+                self.write_file('file1', 'c')
+                newest = self.repo.save()
+                self.assertEqual(
+                    [newest], self.repo.export_snapshots(incremental,
+                                                         since=[full]))
+                self.assertEqual(1, len(self.repo.bundle_heads(incremental)))
+                imported = other_repo.import_snapshots(incremental)
+                self.assertEqual(self.repo.rev_parse(newest),
+                                 other_repo.rev_parse(imported[0]))
+                self.assertEqual(4, len(other_repo.snapshots))
+                self.assertEqual([], self.repo.export_snapshots(
+                    os.path.join(bundles, 'empty.bundle'),
+                    since=[full, incremental]))
+            finally:
+                other_repo.close()
+        finally:
+            shutil.rmtree(other)
+            shutil.rmtree(bundles)
+
+    def test_commit_dates(self):
+        dates = {'GIT_AUTHOR_DATE': '@1000000000 +0200',
+                 'GIT_COMMITTER_DATE': '2001-09-09T01:46:40Z'}
+        saved = dict((name, os.environ.get(name)) for name in dates)
+        os.environ.update(dates)
+        try:
+            self.write_file('file1')
+            snapshot = self.repo.save()
+        finally:
+            twit._set_env(saved)
+        self.assertEqual(1000000000, self.repo.commit_info(snapshot).time)
+        self.assertEqual('1000000000 +0200 1000000000 +0000',
+                         _git('log', '-1', '--format=%ad %cd', '--date=raw',
+                              snapshot))
+
+    def test_worktrees_share_counter(self):
+        self.commit_file('file1')
+        for content in 'ab':
+            self.write_file('file1', content)
+            self.repo.save()
+        linked = os.path.join(tempfile.mkdtemp(), 'linked')
+        try:
+            _git('worktree', 'add', '-q', linked)
+            with _cd(linked):
+                other = self.repo.__class__.from_cwd()
+            try:
+                self.write_file(os.path.join(linked, 'file1'), 'c')
+                self.assertEqual(twit.SNAPSHOT_PREFIX + '3', other.save())
+                self.write_file('file1', 'd')
+                self.assertEqual(twit.SNAPSHOT_PREFIX + '4', self.repo.save())
+                # The counter is shared, so it is not stale in either tree.
+                self.assertEqual(5, other._next_snapshot_index())
+            finally:
+                other.close()
+        finally:
+            shutil.rmtree(os.path.dirname(linked))
+
+    def test_threaded_repos(self):
+        other = tempfile.mkdtemp()
+        try:
+            with _cd(other):
+                _git('init')
+                self.write_file('other_file')
+                other_repo = self.repo.__class__.from_cwd()
+            self.write_file('file1')
+            cwd = os.getcwd()
+
+            def work(repo):
+                refs = []
+                for _ in range(5):
+                    handle, _ = tempfile.mkstemp(dir=repo.workdir)
+                    os.close(handle)
+                    refs.append(repo.save())
+                return refs + [repo.dirty]
+
+            pool = ThreadPool(2)
+            try:
+                results = pool.map(work, [self.repo, other_repo] * 2)
+            finally:
+                pool.close()
+                pool.join()
+            self.assertEqual(cwd, os.getcwd())
+            for result in results:
+                self.assertTrue(result[-1])
+                self.assertEqual(5, len(set(result[:-1])))
+            for index, repo in enumerate((self.repo, other_repo)):
+                saved = set(results[index][:-1] + results[index + 2][:-1])
+                self.assertItemsEqual(saved, repo.snapshots)
+            other_repo.close()
+        finally:
+            shutil.rmtree(other)
+
+    def test_operation(self):
+        self.commit_file('file1')
+        head = self.repo.rev_parse('HEAD')
+        with self.repo.operation():
+            self.assertFalse(self.repo.dirty)
+            self.assertEqual(['refs/heads/master'], self.repo.refs)
+            self.write_file('file1', 'changed')
+            _git('branch', 'other')
+            # Memoized until the repository is changed through the API.
+            self.assertFalse(self.repo.dirty)
+            self.assertEqual(['refs/heads/master'], self.repo.refs)
+            self.repo.commit('Empty', ref='refs/heads/empty')
+            self.assertTrue(self.repo.dirty)
+            self.assertEqual(3, len(self.repo.refs))
+            with self.repo.operation():
+                self.repo.stage_all()
+            self.assertFalse(self.repo.dirty)
+            self.assertEqual(head, self.repo.rev_parse('HEAD'))
+            self.repo.commit('Changed')
+            self.assertNotEqual(head, self.repo.rev_parse('HEAD'))
+        self.write_file('file1', 'again')
+        self.assertTrue(self.repo.dirty)
+
     def test_set_head(self):
         self.commit_file('file1')
         self.repo.set_head('master')
@@ -270,6 +670,23 @@ class SharedTestMixin(object):
         self.assertTrue(os.path.exists('file1'))
         self.assertFalse(os.path.exists('file2'))
 
+    def test_open_snapshot_touches_changed_files(self):
+        self.commit_file('file1', 'one')
+        self.commit_file('file2', 'two')
+        self.write_file('file1', 'changed')
+        snapshot = self.repo.save()
+        self.repo.discard_all()
+        self.assertEqual('', _git('diff-files', '--name-only'))
+        mtime = os.stat('file2').st_mtime
+        os.utime('file2', (mtime - 10, mtime - 10))
+        _git('update-index', '--refresh')
+        self.repo.open_snapshot(snapshot)
+        with open('file1') as rfile:
+            self.assertEqual('changed', rfile.read())
+        self.assertEqual(mtime - 10, os.stat('file2').st_mtime)
+        # The index keeps valid stat info for the untouched file.
+        self.assertEqual('file1', _git('diff-files', '--name-only'))
+
     def test_open(self):
         self.write_file('file1')
         snapshot = self.repo.save()
@@ -292,10 +709,680 @@ class SharedTestMixin(object):
         self.repo.open('master')
         self.assertEqual('refs/heads/master', _git('symbolic-ref', '-q', 'HEAD'))
 
+class BatchTestCase(unittest.TestCase, TempRepoMixin):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_cwd = os.getcwd()
+        self.repos = [os.path.join(self.root, name)
+                      for name in ('a', 'b', os.path.join('nested', 'c'))]
+        for path in self.repos:
+            os.makedirs(path)
+            with _cd(path):
+                _git('init')
+                self.write_file('file1', path)
+        os.mkdir(os.path.join(self.repos[0], 'inner'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_find_repositories(self):
+        self.assertItemsEqual(self.repos, twit.find_repositories(self.root))
+
+    def test_batch_save(self):
+        result = CliRunner().invoke(twit_cli.main,
+                ['save', '--all-under', self.root, '-j', '2'])
+        self.assertEqual(0, result.exit_code, result.output)
+        for path in self.repos:
+            self.assertIn('{}: saved refs/hidden/tags/twit/1'.format(path),
+                          result.output)
+        listing = os.path.join(self.root, 'repos.txt')
+        with open(listing, 'w') as wfile:
+            wfile.write('\n'.join(self.repos[:2] + [self.root]))
+        result = CliRunner().invoke(twit_cli.main,
+                ['snapshots', '--repos', listing])
+        self.assertEqual(1, result.exit_code)
+        for path in self.repos[:2]:
+            self.assertIn(path + ': ', result.output)
+        self.assertIn('1 of 3 repositories failed', result.output)
+
+    def test_batch_unexpected_errors(self):
+        broken = os.path.realpath(self.repos[0])
+
+        def operation(repo):
+            if os.path.realpath(repo.workdir) == broken:
+                raise OSError(errno.EACCES, 'Permission denied')
+            return repo.workdir
+
+        outcomes = list(twit.run_batch(self.repos, operation, jobs=2))
+        self.assertItemsEqual(self.repos, [path for path, _, _ in outcomes])
+        for path, result, error in outcomes:
+            if path == self.repos[0]:
+                self.assertIsNone(result)
+                self.assertIn('Permission denied', error)
+            else:
+                self.assertIsNone(error)
+
+class GitHookTestCase(unittest.TestCase, TempRepoMixin):
+    def setUp(self):
+        self.create_temp_repo()
+
+    def tearDown(self):
+        self.cleanup_temp_repo()
+
+    def test_hooks(self):
+        calls = []
+        twit.add_git_hook(calls.append)
+        try:
+            with GitExeTwitRepo.from_cwd() as repo:
+                self.write_file('file1')
+                repo.save()
+                repo.commit_info(repo.snapshots[0])
+        finally:
+            twit.remove_git_hook(calls.append)
+        subcommands = [call.argv[1] for call in calls]
+        self.assertIn('write-tree', subcommands)
+        self.assertIn('cat-file', subcommands)
+        for call in calls:
+            self.assertEqual('git', call.argv[0])
+            self.assertGreaterEqual(call.duration, 0)
+        # One --batch-check and one --batch coprocess, reused afterwards.
+        spawned = [call.argv[2] for call in calls
+                   if call.argv[1] == 'cat-file' and call.spawned]
+        self.assertItemsEqual(['--batch-check', '--batch'], spawned)
+
+    def test_save_reads_one_snapshot(self):
+        with GitExeTwitRepo.from_cwd() as repo:
+            for content in 'abc':
+                self.write_file('file1', content)
+                repo.save()
+            self.commit_file('file2')
+            calls = []
+            twit.add_git_hook(calls.append)
+            try:
+                snapshot = repo.save()
+                self.assertEqual(snapshot, repo.save())
+            finally:
+                twit.remove_git_hook(calls.append)
+        subcommands = [call.argv[1] for call in calls]
+        self.assertNotIn('for-each-ref', subcommands)
+        self.assertEqual(1, subcommands.count('commit-tree'))
+
+    def test_open_reads_state_once(self):
+        self.commit_file('file1')
+        _git('branch', 'other')
+        self.write_file('file1', 'changed')
+        calls = []
+        backend, twit.TwitRepo = twit.TwitRepo, GitExeTwitRepo
+        twit.add_git_hook(calls.append)
+        try:
+            result = CliRunner().invoke(twit_cli.main, ['open', 'other'])
+        finally:
+            twit.remove_git_hook(calls.append)
+            twit.TwitRepo = backend
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual('refs/heads/other', _git('symbolic-ref', 'HEAD'))
+        # Once before saving, and once after discarding the changes.
+        self.assertEqual(2, [call.argv[1] for call in calls].count('status'))
+
+    def test_profile_option(self):
+        self.write_file('file1')
+        profile = os.path.join(self.workdir, 'profile.json')
+        backend, twit.TwitRepo = twit.TwitRepo, GitExeTwitRepo
+        try:
+            result = CliRunner().invoke(twit_cli.main,
+                    ['--trace', '--profile', profile, 'save'])
+        finally:
+            twit.TwitRepo = backend
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('git: write-tree', result.output)
+        self.assertIn('save: ', result.output)
+        with open(profile) as rfile:
+            summary = json.loads(rfile.read())
+        self.assertEqual('save', summary['command'])
+        self.assertEqual(summary['git_calls'],
+                sum(stats['calls']
+                    for stats in summary['by_subcommand'].values()))
+
+class GitIterTestCase(unittest.TestCase, TempRepoMixin):
+    def setUp(self):
+        self.create_temp_repo()
+
+    def tearDown(self):
+        self.cleanup_temp_repo()
+
+    def test_records(self):
+        for name in ('file1', 'file 2', 'file\n3'):
+            self.write_file(name)
+        records = list(twit._git_iter('ls-files', '-z', '--others', sep='\0',
+                                      cwd=self.workdir))
+        self.assertEqual(['file\n3', 'file 2', 'file1'], records)
+        lines = twit._git_iter('ls-files', '--others', cwd=self.workdir)
+        self.assertEqual('"file\\n3"', next(lines))
+        lines.close()
+
+    def test_errors(self):
+        records = twit._git_iter('rev-list', 'nonexistent', cwd=self.workdir)
+        with self.assertRaises(GitError) as context:
+            list(records)
+        self.assertIn('nonexistent', str(context.exception))
+        with self.assertRaises(GitError):
+            _git('rev-list', 'nonexistent')
+        outside = tempfile.mkdtemp()
+        try:
+            with self.assertRaises(twit.NotARepository):
+                list(twit._git_iter('status', cwd=outside))
+            with self.assertRaises(twit.NotARepository):
+                _git('status', cwd=outside)
+        finally:
+            shutil.rmtree(outside)
+
+    def test_missing(self):
+        missing = os.path.join(self.workdir, 'missing')
+        with self.assertRaises(twit.NotARepository):
+            _git('status', cwd=missing)
+        with self.assertRaises(twit.NotARepository):
+            list(twit._git_iter('status', cwd=missing))
+        path = os.environ['PATH']
+        os.environ['PATH'] = missing
+        try:
+            with self.assertRaises(twit.CannotFindGit):
+                _git('status', cwd=self.workdir)
+        finally:
+            os.environ['PATH'] = path
+
+
+class BenchmarkTestCase(unittest.TestCase, TempRepoMixin):
+    def test_run_benchmarks(self):
+        results = bench_twit.run_benchmarks([(5, 3, 2)], repeat=1)
+        operations = results['5x3x2']
+        self.assertItemsEqual([name for name, _, _ in bench_twit.OPERATIONS],
+                operations)
+        self.assertEqual(1, operations['dirty']['git_processes'])
+        self.assertEqual([], bench_twit.compare(results, results))
+        slower = {'5x3x2': {'dirty': {'wall_ms': 0, 'git_processes': 0}}}
+        self.assertEqual(2, len(bench_twit.compare(results, slower)))
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_eviction(self):
+        cache = _LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+class WatchTestCase(unittest.TestCase, TempRepoMixin):
+    def setUp(self):
+        self.create_temp_repo()
+
+    def tearDown(self):
+        self.cleanup_temp_repo()
+
+    def check_watcher(self, watcher):
+        try:
+            self.assertFalse(watcher.wait(0.05))
+            self.write_file('file1')
+            self.assertTrue(watcher.wait(2))
+            self.assertFalse(watcher.wait(0.05))
+            self.write_file(os.path.join('.git', 'file2'))
+            self.assertFalse(watcher.wait(0.05))
+            os.mkdir('subdir')
+            self.assertTrue(watcher.wait(2))
+            self.write_file(os.path.join('subdir', 'file3'))
+            self.assertTrue(watcher.wait(2))
+            os.remove('file1')
+            self.assertTrue(watcher.wait(2))
+        finally:
+            watcher.close()
+
+    def test_poll_watcher(self):
+        self.check_watcher(twit._PollWatcher(self.workdir, interval=0.01))
+
+    @unittest.skipUnless(twit.INOTIFY, 'inotify_simple is not installed')
+    def test_inotify_watcher(self):
+        self.check_watcher(twit._InotifyWatcher(self.workdir))
+
+    def check_ignored(self, make_watcher):
+        self.write_file('.gitignore', 'build/\nout/\n*.pyc\n')
+        os.makedirs(os.path.join('build', 'lib'))
+        os.mkdir('cache')
+        self.write_file(os.path.join('cache', 'a.pyc'))
+        ignored = twit._IgnoredDirs(self.workdir)
+        self.assertIn(os.path.join(self.workdir, 'build'), ignored)
+        self.assertNotIn(os.path.join(self.workdir, 'cache'), ignored)
+        watcher = make_watcher(ignored)
+        try:
+            self.write_file(os.path.join('build', 'lib', 'file1'))
+            self.assertFalse(watcher.wait(0.1))
+            self.write_file(os.path.join('cache', 'file2'))
+            self.assertTrue(watcher.wait(2))
+            os.mkdir('out')
+            self.assertTrue(watcher.wait(2))
+            self.write_file(os.path.join('out', 'file3'))
+            self.assertFalse(watcher.wait(0.1))
+        finally:
+            watcher.close()
+
+    def test_poll_watcher_ignored(self):
+        self.check_ignored(lambda ignored: twit._PollWatcher(
+            self.workdir, interval=0.01, ignored=ignored))
+
+    @unittest.skipUnless(twit.INOTIFY, 'inotify_simple is not installed')
+    def test_inotify_watcher_ignored(self):
+        self.check_ignored(lambda ignored: twit._InotifyWatcher(
+            self.workdir, ignored=ignored))
+
+    @unittest.skipUnless(twit.INOTIFY, 'inotify_simple is not installed')
+    def test_inotify_watch_limit(self):
+        import inotify_simple
+        add_watch = inotify_simple.INotify.add_watch
+
+        def exhausted(self, path, mask):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+
+        inotify_simple.INotify.add_watch = exhausted
+        try:
+            self.assertIsInstance(twit._watcher(self.workdir),
+                                  twit._PollWatcher)
+        finally:
+            inotify_simple.INotify.add_watch = add_watch
+        watcher = twit._InotifyWatcher(self.workdir, interval=0.01)
+        try:
+            inotify_simple.INotify.add_watch = exhausted
+            try:
+                os.mkdir('subdir')
+                self.assertTrue(watcher.wait(2))
+            finally:
+                inotify_simple.INotify.add_watch = add_watch
+            self.write_file(os.path.join('subdir', 'file1'))
+            self.assertTrue(watcher.wait(2))
+        finally:
+            watcher.close()
+
+    def test_watch(self):
+        repo = GitExeTwitRepo.from_cwd()
+        saved = []
+        stop = threading.Event()
+
+        def callback(ref):
+            saved.append(ref)
+            stop.set()
+
+        thread = threading.Thread(target=repo.watch, kwargs=dict(
+            debounce=0.1, interval=0.02, poll=True, callback=callback,
+            stop=stop))
+        thread.start()
+        try:
+            for content in ('a', 'ab', 'abc'):
+                self.write_file('file1', content)
+                time.sleep(0.02)
+            stop.wait(5)
+        finally:
+            stop.set()
+            thread.join()
+            repo.close()
+        self.assertEqual(1, len(saved))
+        self.assertEqual('abc', _git('show', saved[0] + ':file1'))
+
+
+class DaemonTestCase(unittest.TestCase, TempRepoMixin):
+    def setUp(self):
+        self.create_temp_repo()
+        self.repo = GitExeTwitRepo.from_cwd()
+        self.git_dir = twit._find_git_dir(self.workdir)
+        ready = threading.Event()
+        self.thread = threading.Thread(
+            target=twit.TwitDaemon(self.repo, idle_timeout=10).serve_forever,
+            kwargs={'ready': ready})
+        self.thread.start()
+        ready.wait(5)
+
+    def tearDown(self):
+        twit.stop_daemon(self.git_dir)
+        self.thread.join()
+        self.repo.close()
+        self.cleanup_temp_repo()
+
+    def test_find_git_dir(self):
+        os.mkdir('subdir')
+        self.assertEqual(self.repo.path, twit._find_git_dir('subdir'))
+        self.assertEqual(os.path.realpath(self.repo.path),
+                         os.path.realpath(self.git_dir))
+
+    def test_requests(self):
+        self.commit_file('file1')
+        self.write_file('file1', 'changed')
+        reply = twit._daemon_request(self.git_dir, {'argv': ['save']})
+        self.assertEqual({'status': 0, 'output': 'Snapshot saved.\n',
+                          'errors': ''}, reply)
+        self.assertEqual(1, len(self.repo.snapshots))
+        reply = twit._daemon_request(self.git_dir, {'argv': ['snapshots']})
+        self.assertEqual(1, len(reply['output'].splitlines()))
+        for argv in (['prune', '--keep-last', '0'], ['serve'], []):
+            reply = twit._daemon_request(self.git_dir, {'argv': argv})
+            self.assertEqual(2, reply['status'])
+            self.assertIn('only runs', reply['errors'])
+        self.assertTrue(self.repo.snapshots)
+        reply = twit._daemon_request(self.git_dir, {'argv': ['open']})
+        self.assertEqual(2, reply['status'])
+        self.assertIn('Missing argument', reply['errors'])
+
+    def test_bad_connections(self):
+        self.commit_file('file1')
+        self.write_file('file1', 'changed')
+        for payload in (b'', b'not json\n', b'[]\n'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(twit._daemon_socket(self.git_dir))
+            sock.sendall(payload)
+            sock.close()
+        reply = twit._daemon_request(self.git_dir, {'argv': ['save']})
+        self.assertEqual(0, reply['status'], reply['errors'])
+        self.assertEqual(1, len(self.repo.snapshots))
+
+    def test_client_state(self):
+        self.commit_file('file1')
+        nested = os.path.join(self.workdir, 'subdir', 'nested')
+        os.makedirs(nested)
+        with _cd(nested):
+            _git('init')
+            self.write_file('file2')
+        self.write_file('file1', 'changed')
+        env = dict((name, os.environ[name]) for name in twit.DAEMON_ENV
+                   if name in os.environ)
+        env['GIT_AUTHOR_NAME'] = 'Daemon Client'
+        reply = twit._daemon_request(self.git_dir, {
+            'argv': ['save', '--all-under', '.'],
+            'cwd': os.path.join(self.workdir, 'subdir'), 'env': env})
+        self.assertEqual(0, reply['status'], reply['errors'])
+        self.assertEqual(os.path.realpath(self.workdir),
+                         os.path.realpath(os.getcwd()))
+        self.assertNotEqual('Daemon Client', os.environ.get('GIT_AUTHOR_NAME'))
+        self.assertEqual([], self.repo.snapshots)
+        with _cd(nested):
+            self.assertEqual('Daemon Client', _git(
+                'log', '-1', '--format=%an', '--branches=hidden',
+                '--glob=' + twit.SNAPSHOT_PREFIX + '*'))
+
+    def test_forwarding(self):
+        self.assertEqual(None, twit._forward_to_daemon(['prune']))
+        self.assertEqual(0, twit._forward_to_daemon(['snapshots']))
+        twit.stop_daemon(self.git_dir)
+        self.thread.join()
+        self.assertFalse(os.path.exists(twit._daemon_socket(self.git_dir)))
+        self.assertEqual(None, twit._forward_to_daemon(['snapshots']))
+        self.assertFalse(twit.stop_daemon(self.git_dir))
+
+
+# Milliseconds `import twit` may take; a shell prompt runs twit each time.
+IMPORT_BUDGET_MS = 75
+
+
+class ImportTestCase(unittest.TestCase):
+    def test_import_budget(self):
+        script = ('import sys, time; start = time.time(); import twit; '
+                  'print(time.time() - start); print(" ".join(sys.modules))')
+        times = []
+        for _ in range(3):
+            output = subprocess.check_output(
+                [sys.executable, '-c', script],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+            elapsed, modules = output.decode().splitlines()
+            times.append(float(elapsed) * 1000)
+        for name in ('click', 'pygit2', 'github3', 'json', 'datetime',
+                     'socket', 'tempfile', 'inotify_simple',
+                     'multiprocessing.pool'):
+            self.assertNotIn(name, modules.split())
+        self.assertLess(min(times), IMPORT_BUDGET_MS)
+
+    def test_broken_pygit2_falls_back(self):
+        backend, twit.TwitRepo = twit.TwitRepo, Pygit2TwitRepo
+        module = sys.modules.get('pygit2')
+        selected = os.environ.pop('TWIT_BACKEND', None)
+        # A None entry makes importing pygit2 raise ImportError.
+        sys.modules['pygit2'] = None
+        try:
+            self.assertIs(GitExeTwitRepo, twit._repo_class())
+            self.assertIs(GitExeTwitRepo, twit.TwitRepo)
+        finally:
+            twit.TwitRepo = backend
+            if module is None:
+                del sys.modules['pygit2']
+            else:
+                sys.modules['pygit2'] = module
+            if selected is not None:
+                os.environ['TWIT_BACKEND'] = selected
+
+    def test_unknown_backend(self):
+        here = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, TWIT_BACKEND='bogus')
+        subprocess.check_call([sys.executable, '-c', 'import twit'],
+                              cwd=here, env=env)
+        output = subprocess.check_output(
+            [sys.executable, os.path.join(here, 'twit.py'), 'help'],
+            cwd=here, env=env)
+        self.assertIn(b'Usage', output)
+        selected = os.environ.get('TWIT_BACKEND')
+        os.environ['TWIT_BACKEND'] = 'bogus'
+        try:
+            with self.assertRaises(twit.TwitError) as caught:
+                twit._repo_class()
+            self.assertIn('bogus', str(caught.exception))
+        finally:
+            if selected is None:
+                del os.environ['TWIT_BACKEND']
+            else:
+                os.environ['TWIT_BACKEND'] = selected
+
+
+class Sha256TestCase(unittest.TestCase, TempRepoMixin):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.workdir)
+        _git('init', '--object-format=sha256')
+
+    def tearDown(self):
+        self.cleanup_temp_repo()
+
+    def test_open_unborn_snapshot(self):
+        with GitExeTwitRepo.from_cwd() as repo:
+            self.assertEqual(64, len(repo.empty_tree()))
+            self.write_file('file1')
+            snapshot = repo.save()
+            os.remove('file1')
+            repo.open_snapshot(snapshot)
+        self.assertTrue(os.path.exists('file1'))
+
+
+class GitDateTestCase(unittest.TestCase):
+    def test_parse_git_date(self):
+        for value, expected in [
+                ('@1000000000', (1000000000, 0)),
+                ('1000000000 -0130', (1000000000, -90)),
+                ('2001-09-09T03:46:40+02:00', (1000000000, 120)),
+                ('2001-09-09 01:46:40 Z', (1000000000, 0)),
+                ('Sun, 09 Sep 2001 03:46:40 +0200', (1000000000, 120))]:
+            self.assertEqual(expected, twit._parse_git_date(value))
+        with self.assertRaises(GitError):
+            twit._parse_git_date('next tuesday')
+
+
+@unittest.skipUnless(PYGIT2, 'pygit2 is not installed')
+class Pygit2ErrorTestCase(unittest.TestCase, TempRepoMixin):
+    def setUp(self):
+        self.create_temp_repo()
+        self.repo = Pygit2TwitRepo.from_cwd()
+
+    def tearDown(self):
+        self.repo.close()
+        self.cleanup_temp_repo()
+
+    def test_errors_are_git_errors(self):
+        names = ('GIT_AUTHOR_NAME', 'GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_NAME',
+                 'GIT_COMMITTER_EMAIL', 'HOME', 'XDG_CONFIG_HOME',
+                 'GIT_CONFIG_NOSYSTEM')
+        saved = dict((name, os.environ.get(name)) for name in names)
+        twit._set_env(dict((name, None) for name in names))
+        os.environ['HOME'] = self.workdir
+        os.environ['GIT_CONFIG_NOSYSTEM'] = '1'
+        try:
+            self.write_file('file1')
+            with self.assertRaises(GitError):
+                self.repo.save()
+        finally:
+            twit._set_env(saved)
+
+
+class RemoveFilesTestCase(unittest.TestCase, TempRepoMixin):
+    def setUp(self):
+        self.create_temp_repo()
+
+    def tearDown(self):
+        self.cleanup_temp_repo()
+
+    def test_remove_files(self):
+        paths = []
+        for index in range(10):
+            dirname = os.path.join('dir{}'.format(index % 3), 'sub')
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            paths.append('dir{}/sub/file{}'.format(index % 3, index))
+            self.write_file(paths[-1])
+        self.write_file(os.path.join('dir0', 'other'))
+        counts = twit._remove_files(self.workdir,
+                                    iter(paths + ['missing', 'dir1', '']),
+                                    jobs=3, batch_size=4)
+        self.assertEqual(twit.RemovalCounts(10, 5), counts)
+        self.assertItemsEqual(['.git', 'dir0'], os.listdir('.'))
+        self.assertEqual(['other'], os.listdir('dir0'))
+
+
+class RetentionTestCase(unittest.TestCase):
+    def test_retained_snapshots(self):
+        hour = 60 * 60
+        now = 100 * 24 * hour
+        infos = [RefInfo('s{}'.format(age), 'oid', now - age * hour, '')
+                 for age in (0, 0.5, 1, 1.5, 30, 31, 24 * 10, 24 * 40)]
+        keep = twit._retained_snapshots
+        self.assertEqual(set(['s0', 's0.5']), keep(infos, now, keep_last=2))
+        self.assertEqual(set(['s0', 's1']), keep(infos, now, hourly=2))
+        self.assertEqual(set(['s0', 's30', 's240']),
+                         keep(infos, now, daily=30))
+        self.assertEqual(set(['s0', 's1', 's240', 's960']),
+                         keep(infos, now, hourly=2, weekly=10))
+
+
+@unittest.skipIf(PY2, 'asyncio requires Python 3')
+class AsyncTwitRepoTestCase(unittest.TestCase, TempRepoMixin):
+    def setUp(self):
+        self.create_temp_repo()
+
+    def tearDown(self):
+        self.cleanup_temp_repo()
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_save_and_open(self):
+        async def scenario():
+            repo = await AsyncTwitRepo.from_path(self.workdir)
+            self.write_file('file1')
+            self.assertTrue(await repo.dirty())
+            self.assertFalse(await repo.dirty(untracked=False))
+            snapshot = await repo.save()
+            self.assertEqual(snapshot, await repo.save())
+            infos = await repo.snapshots()
+            self.assertEqual([snapshot], [info.ref for info in infos])
+            os.remove('file1')
+            await repo.open(snapshot)
+            self.assertTrue(os.path.exists('file1'))
+            self.assertEqual('refs/heads/master',
+                    _git('symbolic-ref', '-q', 'HEAD'))
+            self.assert_empty_stage()
+            self.commit_file('file2', 'original')
+            info = await repo.commit_info('HEAD')
+            self.assertEqual('Created file2', info.message.rstrip())
+            self.write_file('file2', 'changes')
+            snapshot2 = await repo.save()
+            _git('add', '--all', '.')
+            _git('reset', '--hard', 'HEAD')
+            await repo.open(snapshot2)
+            with open('file2') as rfile:
+                self.assertEqual('changes', rfile.read())
+            self.assertEqual('refs/heads/master',
+                    _git('symbolic-ref', '-q', 'HEAD'))
+        self.run_async(scenario())
+
+    def test_sha256_unborn_snapshot(self):
+        shutil.rmtree('.git')
+        _git('init', '--object-format=sha256')
+
+        async def scenario():
+            repo = await AsyncTwitRepo.from_path(self.workdir)
+            self.write_file('file1')
+            snapshot = await repo.save()
+            os.remove('file1')
+            await repo.open(snapshot)
+        self.run_async(scenario())
+        self.assertTrue(os.path.exists('file1'))
+
+    def test_git_errors(self):
+        async def scenario():
+            repo = await AsyncTwitRepo.from_path(self.workdir)
+            self.commit_file('file1')
+            _git('branch', 'other')
+            self.write_file(os.path.join('.git', 'index.lock'), '')
+            with self.assertRaises(GitError) as context:
+                await repo.open('other')
+            self.assertIn('index.lock', str(context.exception))
+            records = repo._git_records('rev-list', 'nonexistent')
+            with self.assertRaises(GitError):
+                async for _ in records:
+                    pass
+        self.run_async(scenario())
+
+    def test_concurrent_repos(self):
+        paths = [tempfile.mkdtemp() for _ in range(3)]
+        try:
+            for path in paths:
+                with _cd(path):
+                    _git('init')
+                    self.write_file('file1', path)
+
+            async def scenario():
+                semaphore = asyncio.Semaphore(2)
+                repos = await asyncio.gather(*[
+                    AsyncTwitRepo.from_path(path, semaphore=semaphore)
+                    for path in paths])
+                refs = await asyncio.gather(*[repo.save() for repo in repos])
+                listings = await asyncio.gather(*[repo.snapshots()
+                                                  for repo in repos])
+                return refs, listings
+            refs, listings = self.run_async(scenario())
+            for ref, listing in zip(refs, listings):
+                self.assertEqual([ref], [info.ref for info in listing])
+        finally:
+            for path in paths:
+                shutil.rmtree(path)
+
 # Use the GitRepoTestMixin to test GitExeRepo
 class GitExeRepoTestCase(unittest.TestCase, SharedTestMixin):
     def setUp(self):
         self.create_temp_repo()
         self.repo = GitExeTwitRepo.from_cwd()
     def tearDown(self):
+        self.repo.close()
+        self.cleanup_temp_repo()
+
+# Use the GitRepoTestMixin to test Pygit2Repo
+@unittest.skipUnless(PYGIT2, 'pygit2 is not installed')
+class Pygit2RepoTestCase(unittest.TestCase, SharedTestMixin):
+    def setUp(self):
+        self.create_temp_repo()
+        self.repo = Pygit2TwitRepo.from_cwd()
+    def tearDown(self):
+        self.repo.close()
         self.cleanup_temp_repo()
@@ -2,26 +2,135 @@
 """Twit: an easier Git frontend.  """
 import os
 import re
+import stat
+import errno
 import sys
 import time
-import json
-import datetime
+import io
+import binascii
+import importlib
+import threading
 import subprocess
+import functools
 import contextlib
 import collections
 
-import click
 
-try:
-    import github3  # NOQA
-    GITHUB3 = True
-except ImportError:
-    GITHUB3 = False
+# Modules that only some code paths need are imported on first use, so that
+# `import twit` stays cheap for shell prompts and the daemon client. The
+# command line interface, and with it click, lives in twit_cli.
+
+class _LazyModule(object):
+    """Stand-in for a module, importing it on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def _module_available(name):
+    """Check whether a module can be imported, without importing it."""
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        import imp
+        try:
+            imp.find_module(name)
+            return True
+        except ImportError:
+            return False
+    return find_spec(name) is not None
+
+
+json = _LazyModule('json')
+shutil = _LazyModule('shutil')
+socket = _LazyModule('socket')
+tempfile = _LazyModule('tempfile')
+
+PYGIT2 = _module_available('pygit2')
+pygit2 = _LazyModule('pygit2')
+
+INOTIFY = _module_available('inotify_simple')
+inotify_simple = _LazyModule('inotify_simple')
 
 PY2 = sys.version_info[0] == 2
 
-CommitInfo = collections.namedtuple('CommitInfo',
-        ('message', 'time', 'parents', 'tree'))
+
+class CommitInfo(object):
+    """Parsed commit metadata.
+
+    Object ids are kept as raw bytes rather than hex strings, so large
+    numbers of cached commits stay small in memory.
+    """
+
+    __slots__ = ('message', 'time', '_tree', '_parents')
+
+    def __init__(self, message, time, parents, tree):
+        self.message = message
+        self.time = time
+        self._tree = binascii.unhexlify(tree)
+        self._parents = b''.join(binascii.unhexlify(parent)
+                                 for parent in parents)
+
+    @staticmethod
+    def _hex(raw):
+        oid = binascii.hexlify(raw)
+        return oid if PY2 else oid.decode()
+
+    @property
+    def tree(self):
+        return self._hex(self._tree)
+
+    @property
+    def parents(self):
+        size = len(self._tree)
+        return [self._hex(self._parents[i:i + size])
+                for i in range(0, len(self._parents), size)]
+
+    def _asdict(self):
+        return {'message': self.message, 'time': self.time,
+                'parents': self.parents, 'tree': self.tree}
+
+    def __eq__(self, other):
+        if not isinstance(other, CommitInfo):
+            return NotImplemented
+        return self._asdict() == other._asdict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.message, self.time, self._tree, self._parents))
+
+    def __repr__(self):
+        return ('CommitInfo(message={0.message!r}, time={0.time!r}, '
+                'parents={0.parents!r}, tree={0.tree!r})'.format(self))
+
+
+RefInfo = collections.namedtuple('RefInfo',
+        ('ref', 'oid', 'time', 'subject'))
+
+# `git for-each-ref` arguments listing RefInfo records newest first. Refs
+# with the same date are ordered by the numbers in their names, highest
+# first, so later snapshots come before earlier ones.
+_REF_INFO_ARGS = ('for-each-ref', '--sort=-version:refname',
+                  '--sort=-authordate',
+                  '--format=%(refname)%00%(objectname)'
+                  '%00%(authordate:unix)%00%(subject)')
+
+def _parse_ref_info(record):
+    """Build a RefInfo from a record in the _REF_INFO_ARGS format."""
+    ref, oid, timestamp, subject = record.split('\0', 3)
+    return RefInfo(ref=ref, oid=oid, time=int(timestamp or 0),
+                   subject=subject)
+
+RemovalCounts = collections.namedtuple('RemovalCounts',
+        ('files', 'directories'))
 
 class TwitError(Exception):
     """Generic error for Twit."""
@@ -59,67 +168,726 @@ class CannotFindGit(GitError):
     """Script could not locate the git executable."""
 
 
-def _git_nostrip(*args):
-    """Delegate to the Git executable, returning unstripped output."""
+GitCall = collections.namedtuple('GitCall',
+        ('argv', 'duration', 'output_bytes', 'returncode', 'spawned'))
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+_git_hooks = []
+
+def add_git_hook(hook):
+    """Call ``hook(call)`` with a GitCall record for every git invocation.
+
+    Requests served by a long-lived cat-file coprocess are reported with
+    ``spawned`` set to False, and processes stopped early by the caller
+    with a ``returncode`` of None.
+    """
+    _git_hooks.append(hook)
+
+def remove_git_hook(hook):
+    """Stop reporting git invocations to a hook."""
+    _git_hooks.remove(hook)
+
+def _report_git_call(argv, started, output_bytes, returncode, spawned=True):
+    if not _git_hooks:
+        return
+    call = GitCall(argv=tuple(argv), duration=_clock() - started,
+                   output_bytes=output_bytes, returncode=returncode,
+                   spawned=spawned)
+    for hook in list(_git_hooks):
+        hook(call)
+
+def _git_error(stderr):
+    """Return the exception for a git command that failed with ``stderr``."""
+    if not PY2:
+        stderr = stderr.decode('utf-8', 'replace')
+    if 'not a git repository' in stderr.lower():
+        return NotARepository("current directory is not part of a repository")
+    return GitError(stderr.strip())
+
+def _not_found(cwd):
+    """Return the exception for git failing to start with ENOENT, which
+    means either git or the directory it should run in is missing."""
+    if cwd is not None and not os.path.isdir(cwd):
+        return NotARepository("directory {} does not exist".format(cwd))
+    return CannotFindGit("git executable not found")
+
+def _git_nostrip(*args, **kwargs):
+    """Delegate to the Git executable, returning unstripped output.
+
+    The ``cwd`` keyword sets the directory git runs in, ``env`` adds
+    variables to the subprocess environment, and ``input`` is written to
+    git's standard input. Raises GitError, with git's error output, if git
+    fails.
+    """
+    env = kwargs.get('env')
+    if env:
+        env = dict(os.environ, **env)
+    stdin = kwargs.get('input')
+    started = _clock()
     try:
         proc = subprocess.Popen(('git',) + args, stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-        stdout, _ = proc.communicate()
+                                stderr=subprocess.PIPE, env=env,
+                                cwd=kwargs.get('cwd'),
+                                stdin=subprocess.PIPE if stdin else None)
+        stdout, stderr = proc.communicate(
+            stdin.encode('utf-8') if stdin else None)
     except OSError as error:
-        if error.errno == os.errno.ENOENT:
-            raise CannotFindGit("git executable not found")
+        if error.errno == errno.ENOENT:
+            raise _not_found(kwargs.get('cwd'))
         else:
             raise
-    if not PY2:
-        stdout = stdout.decode()
-    if 'fatal: Not a git repository' in stdout:
-        raise NotARepository("current directory is not part of a repository")
-    return stdout
+    _report_git_call(('git',) + args, started, len(stdout), proc.returncode)
+    if proc.returncode:
+        raise _git_error(stderr)
+    return stdout if PY2 else stdout.decode()
 
-def _git(*args):
+def _git(*args, **kwargs):
     """Delegate to the Git executable."""
-    return _git_nostrip(*args).rstrip()
+    return _git_nostrip(*args, **kwargs).rstrip()
+
+class _RecordSplitter(object):
+    """Split chunks of git output into separator-delimited text records."""
+
+    def __init__(self, sep='\n'):
+        self.sep = sep.encode('ascii')
+        self._pending = b''
+
+    def feed(self, chunk):
+        """Return the records completed by a chunk of output."""
+        records = (self._pending + chunk).split(self.sep)
+        self._pending = records.pop()
+        return records if PY2 else [record.decode() for record in records]
+
+    def flush(self):
+        """Return the final record, if the output did not end with a
+        separator."""
+        pending, self._pending = self._pending, b''
+        if not pending:
+            return []
+        return [pending if PY2 else pending.decode()]
+
+def _git_iter(*args, **kwargs):
+    """Delegate to the Git executable, yielding records as they arrive.
+
+    Records are separated by the ``sep`` keyword (a newline by default), and
+    only one chunk of output is held at a time. Error output is collected
+    apart from the records; if git fails, GitError is raised with it once
+    the records are exhausted. Closing the generator early terminates the
+    git process instead.
+    """
+    splitter = _RecordSplitter(kwargs.get('sep', '\n'))
+    started = _clock()
+    output_bytes = 0
+    errors = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(('git',) + args, stdout=subprocess.PIPE,
+                                stderr=errors, cwd=kwargs.get('cwd'))
+    except OSError as error:
+        errors.close()
+        if error.errno == errno.ENOENT:
+            raise _not_found(kwargs.get('cwd'))
+        else:
+            raise
+    finished = False
+    try:
+        while True:
+            chunk = os.read(proc.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            output_bytes += len(chunk)
+            for record in splitter.feed(chunk):
+                yield record
+        for record in splitter.flush():
+            yield record
+        finished = True
+    finally:
+        killed = not finished and proc.poll() is None
+        if killed:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+        errors.seek(0)
+        stderr = errors.read()
+        errors.close()
+        _report_git_call(('git',) + args, started, output_bytes,
+                         None if killed else proc.returncode)
+    if proc.returncode:
+        raise _git_error(stderr)
+
+class _CatFile(object):
+    """Long-lived `git cat-file --batch` coprocess for reading objects.
+
+    Revisions are written to the process one per line, so resolving a ref or
+    reading an object costs a pipe round trip instead of a process startup.
+    Pass ``batch='--batch-check'`` to only resolve object names and types.
+    """
+
+    def __init__(self, path, batch='--batch'):
+        self.path = path
+        self.batch = batch
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        devnull = io.open(os.devnull, 'wb')
+        try:
+            self.proc = subprocess.Popen(('git', 'cat-file', self.batch),
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=devnull, cwd=self.path)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                raise _not_found(self.path)
+            else:
+                raise
+        finally:
+            devnull.close()
+
+    def query(self, rev):
+        """Return ``(oid, type, data)`` for a revision, or None if missing.
+
+        ``data`` is None when running in ``--batch-check`` mode.
+        """
+        if not rev or '\n' in rev:
+            return None
+        started = _clock()
+        with self.lock:
+            spawned = self.proc is None or self.proc.poll() is not None
+            if spawned:
+                self._start()
+            self.proc.stdin.write(rev.encode('utf-8') + b'\n')
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline()
+            if not header:
+                self.close()
+                raise GitError("git cat-file exited unexpectedly")
+            header = header.decode('utf-8').rstrip('\n')
+            argv = ('git', 'cat-file', self.batch, rev)
+            if header.endswith((' missing', ' ambiguous')):
+                _report_git_call(argv, started, len(header), 0, spawned)
+                return None
+            oid, type_, size = header.rsplit(' ', 2)
+            if self.batch == '--batch-check':
+                _report_git_call(argv, started, len(header), 0, spawned)
+                return oid, type_, None
+            data = self.proc.stdout.read(int(size) + 1)[:-1]
+            _report_git_call(argv, started, len(header) + len(data), 0,
+                             spawned)
+        if not PY2:
+            data = data.decode()
+        return oid, type_, data
+
+    def close(self):
+        """Shut down the coprocess."""
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+
+
+class _RefStore(object):
+    """Pure-Python reader for HEAD, loose refs and packed-refs.
+
+    File contents and directory listings are cached against their stat
+    signature, so repeated queries cost a few ``stat`` calls rather than a
+    git process. Lookups return None when a question needs the git
+    executable, such as revision expressions like ``HEAD^``.
+    """
+
+    # Per-worktree refs live in the worktree's own git directory.
+    PER_WORKTREE = ('refs/bisect/', 'refs/worktree/', 'refs/rewritten/')
+
+    # Same order as git's own ref_rev_parse_rules.
+    DWIM_RULES = ('{}', 'refs/{}', 'refs/tags/{}', 'refs/heads/{}',
+                  'refs/remotes/{}', 'refs/remotes/{}/HEAD')
+
+    SIMPLE_NAME = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9._/-]*$')
+    HEXISH = re.compile(r'^[0-9a-fA-F]{4,}$')
+    OID = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
 
-class _cd(object):
-    """Context manager to temporarily change directory."""
     def __init__(self, path):
         self.path = path
+        self._files = {}
+        self._dirs = {}
+        self._packed = (None, {})
+        commondir = self._read(os.path.join(path, 'commondir'))
+        if commondir:
+            self.common_path = os.path.normpath(os.path.join(path, commondir))
+        else:
+            self.common_path = path
+
+    @staticmethod
+    def _signature(stat):
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def _read(self, filename):
+        """Return the stripped contents of a file, or None if missing."""
+        try:
+            signature = self._signature(os.stat(filename))
+        except OSError:
+            return None
+        cached = self._files.get(filename)
+        if cached and cached[0] == signature:
+            return cached[1]
+        try:
+            with io.open(filename, 'rb') as rfile:
+                contents = rfile.read().decode('utf-8').strip()
+        except (IOError, OSError):
+            return None
+        self._files[filename] = (signature, contents)
+        return contents
+
+    def _listdir(self, dirname):
+        """Return the (cached) entries of a directory."""
+        try:
+            signature = self._signature(os.stat(dirname))
+        except OSError:
+            return []
+        cached = self._dirs.get(dirname)
+        if cached and cached[0] == signature:
+            return cached[1]
+        names = sorted(os.listdir(dirname))
+        self._dirs[dirname] = (signature, names)
+        return names
+
+    def _base(self, name):
+        if name.startswith(self.PER_WORKTREE) or not name.startswith('refs/'):
+            return self.path
+        return self.common_path
+
+    def packed(self):
+        """Return a mapping of packed ref names to oids."""
+        filename = os.path.join(self.common_path, 'packed-refs')
+        try:
+            signature = self._signature(os.stat(filename))
+        except OSError:
+            return {}
+        if self._packed[0] == signature:
+            return self._packed[1]
+        packed = {}
+        for line in (self._read(filename) or '').split('\n'):
+            if not line or line[0] in '#^':
+                continue
+            oid, _, name = line.partition(' ')
+            packed[name.strip()] = oid
+        self._packed = (signature, packed)
+        return packed
+
+    def read_raw(self, name):
+        """Return ``ref: <target>`` or an oid for a full ref name."""
+        contents = self._read(os.path.join(self._base(name), name))
+        if contents is not None:
+            return contents
+        return self.packed().get(name)
+
+    def resolve(self, name, depth=5):
+        """Resolve a full ref name to an oid, or None if it does not exist."""
+        raw = self.read_raw(name)
+        if raw is None:
+            return None
+        if raw.startswith('ref:'):
+            if depth <= 0:
+                return None
+            return self.resolve(raw[4:].strip(), depth - 1)
+        if not self.OID.match(raw):
+            return None
+        return raw
+
+    def symbolic_head(self):
+        """Return the ref HEAD points to, or None if HEAD is detached."""
+        raw = self.read_raw('HEAD') or ''
+        if raw.startswith('ref:'):
+            return raw[4:].strip()
+        return None
+
+    def items(self, prefix='refs/'):
+        """Return sorted ``(name, oid)`` pairs for refs under a prefix."""
+        names = set(name for name in self.packed() if name.startswith(prefix))
+        for base in set((self.path, self.common_path)):
+            stack = ['refs']
+            while stack:
+                rel = stack.pop()
+                for entry in self._listdir(os.path.join(base, rel)):
+                    name = rel + '/' + entry
+                    if os.path.isdir(os.path.join(base, name)):
+                        if (name + '/').startswith(prefix) or \
+                                prefix.startswith(name + '/'):
+                            stack.append(name)
+                    elif name.startswith(prefix) and \
+                            not name.endswith('.lock') and \
+                            self._base(name) == base:
+                        names.add(name)
+        pairs = []
+        for name in sorted(names):
+            oid = self.resolve(name)
+            if oid:
+                pairs.append((name, oid))
+        return pairs
+
+    def rev_parse(self, rev):
+        """Resolve a simple ref name as `git rev-parse --verify` would.
+
+        Returns an empty string if the name does not resolve, or None if the
+        revision is not a plain ref name and git must be consulted.
+        """
+        if not self.SIMPLE_NAME.match(rev) or self.HEXISH.match(rev) or \
+                '..' in rev or '//' in rev or rev.endswith(('/', '.lock')):
+            return None
+        if rev != 'HEAD' and rev.isupper():
+            return None
+        for rule in self.DWIM_RULES:
+            name = rule.format(rev)
+            if name == rev and rev != 'HEAD' and not rev.startswith('refs/'):
+                continue
+            oid = self.resolve(name)
+            if oid:
+                return oid
+        return ''
+
+
+def _parse_commit(raw_commit):
+    """Parse a raw commit object into a CommitInfo."""
+    paragraphs = raw_commit.split('\n\n')
+    lines = paragraphs[0].split('\n')
+    message = '\n\n'.join(paragraphs[1:])
+    tree = lines.pop(0).split(' ')[1]
+    parents = []
+    while lines[0].startswith('parent'):
+        parent = lines.pop(0).split(' ')[1]
+        parents.append(parent)
+    raw_author = lines.pop(0)
+    author_match = re.match(r'^.*? (.*) (\d+) .*$', raw_author)
+    author, author_timestamp = author_match.groups()
+
+    return CommitInfo(message=message,
+                      time=int(author_timestamp),
+                      tree=tree,
+                      parents=parents)
+
+
+class _LRUCache(object):
+    """Bounded mapping that evicts the least recently used entries."""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class _CommitStore(object):
+    """On-disk store of parsed commits, keyed by oid.
+
+    Entries are JSON files fanned out like loose objects. Commits are
+    immutable, so entries never need to be invalidated.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, oid):
+        return os.path.join(self.path, oid[:2], oid[2:])
+
+    def get(self, oid):
+        try:
+            with io.open(self._filename(oid), encoding='utf-8') as rfile:
+                return CommitInfo(**json.load(rfile))
+        except (IOError, OSError, ValueError, TypeError):
+            return None
+
+    def put(self, oid, info):
+        filename = self._filename(oid)
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            temp = '{}.{}.tmp'.format(filename, os.getpid())
+            with io.open(temp, 'w', encoding='utf-8') as wfile:
+                wfile.write(u'{}'.format(json.dumps(info._asdict())))
+            getattr(os, 'replace', os.rename)(temp, filename)
+        except (IOError, OSError):
+            pass
+
+
+def _remove_files(root, paths, jobs=8, batch_size=1000):
+    """Delete files under ``root``, then the directories left empty.
+
+    ``paths`` are relative and may be a stream; they are removed in batches
+    from a thread pool as they arrive. Paths that are already gone or that
+    name directories (such as submodules) are skipped. Returns
+    RemovalCounts.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    def batches():
+        batch = []
+        for path in paths:
+            if path:
+                batch.append(path)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def remove(batch):
+        removed = 0
+        for path in batch:
+            filename = os.path.join(root, path)
+            try:
+                os.remove(filename)
+                removed += 1
+            except OSError:
+                if os.path.lexists(filename) and \
+                        not os.path.isdir(filename):
+                    raise
+        return removed, set(os.path.dirname(path) for path in batch)
+
+    files = 0
+    dirnames = set()
+    pool = ThreadPool(max(1, jobs))
+    try:
+        for removed, parents in pool.imap_unordered(remove, batches()):
+            files += removed
+            for dirname in parents:
+                while dirname and dirname not in dirnames:
+                    dirnames.add(dirname)
+                    dirname = os.path.dirname(dirname)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Deepest first, so a directory's children are gone before it is tried.
+    directories = 0
+    for dirname in sorted(dirnames, key=lambda name: name.count('/'),
+                          reverse=True):
+        try:
+            os.rmdir(os.path.join(root, dirname))
+            directories += 1
+        except OSError:
+            pass
+    return RemovalCounts(files, directories)
+
+
+# Prints the oid of the empty tree in the repository's object format (SHA-1
+# or SHA-256). git knows that tree without it being stored.
+_EMPTY_TREE_ARGS = ('hash-object', '-t', 'tree', os.devnull)
+
+
+@contextlib.contextmanager
+def _private_index(path):
+    """Yield the environment selecting a temporary copy of the index in
+    git directory ``path``, which is removed afterwards."""
+    index = os.path.join(path, 'index')
+    handle, temp_index = tempfile.mkstemp(prefix='twit-index-', dir=path)
+    os.close(handle)
+    try:
+        if os.path.exists(index):
+            shutil.copyfile(index, temp_index)
+        else:
+            os.remove(temp_index)
+        yield {'GIT_INDEX_FILE': temp_index}
+    finally:
+        if os.path.exists(temp_index):
+            os.remove(temp_index)
+
+
+class RefTransaction(object):
+    """A batch of ref updates applied by one `git update-ref --stdin`.
+
+    Either every queued update is applied or, if any of them fails (for
+    example because a ref no longer has the expected old value), none are.
+    An ``old`` value of None skips the check; use ``create`` to require
+    that a ref does not exist yet. Each ref may be named only once per
+    transaction. Used as a context manager, the transaction commits on
+    exit unless an exception was raised.
+    """
+
+    def __init__(self, path, on_commit=None):
+        self.path = path
+        self.on_commit = on_commit
+        self._commands = []
+
+    def __len__(self):
+        return len(self._commands)
+
     def __enter__(self):
-        self.old_cwd = os.getcwd()
-        os.chdir(self.path)
-    def __exit__(self, type_, value, traceback):
-        os.chdir(self.old_cwd)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def _queue(self, *fields):
+        self._commands.append(' '.join(field for field in fields if field))
+
+    def create(self, ref, new):
+        """Create ``ref`` at ``new``, failing if it already exists."""
+        self._queue('create', ref, new)
+
+    def update(self, ref, new, old=None):
+        """Point ``ref`` at ``new``, optionally checking its old value."""
+        self._queue('update', ref, new, old)
+
+    def delete(self, ref, old=None):
+        """Delete ``ref``, optionally checking its old value."""
+        self._queue('delete', ref, old)
+
+    def verify(self, ref, old=None):
+        """Check that ``ref`` has the value ``old`` (None: does not exist)."""
+        self._queue('verify', ref, old)
+
+    def abort(self):
+        """Forget the queued updates."""
+        self._commands = []
+
+    def commit(self):
+        """Apply the queued updates, raising GitError if any fails."""
+        commands, self._commands = self._commands, []
+        if not commands:
+            return
+        try:
+            _git_nostrip('update-ref', '--stdin', cwd=self.path,
+                         input=''.join(line + '\n' for line in commands))
+        finally:
+            if self.on_commit is not None:
+                self.on_commit()
+
+
+def _mutator(method):
+    """Mark a repository method that can change HEAD, refs, the index or
+    the work tree, dropping any state memoized by the current operation."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._invalidate()
+    return wrapper
 
 
 class GitExeRepo(object):
     """Git repository backed by Git plumbing shell commands."""
 
-    def __init__(self, path, workdir=None):
+    def __init__(self, path, workdir=None, persist_commits=None):
+        """Open a repository.
+
+        Parsed commits are also kept on disk, under ``twit/commits`` in the
+        git directory, if ``persist_commits`` is True or, when it is None,
+        if the TWIT_COMMIT_CACHE environment variable is set to 1.
+        """
         self.path = os.path.abspath(path)
         self.workdir = workdir or os.path.dirname(path)
+        self._refs = _RefStore(self.path)
+        self._commits = _LRUCache()
+        self._commit_store = None
+        if persist_commits is None:
+            persist_commits = os.environ.get('TWIT_COMMIT_CACHE') == '1'
+        if persist_commits:
+            self._commit_store = _CommitStore(
+                os.path.join(self._refs.common_path, 'twit', 'commits'))
+        self._revs = _CatFile(self.path, batch='--batch-check')
+        self._objects = _CatFile(self.path)
+        self._local = threading.local()
+        self._empty_tree = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def close(self):
+        """Shut down any git coprocesses owned by this repository."""
+        self._revs.close()
+        self._objects.close()
 
     @classmethod
-    def from_cwd(cls):
+    def from_cwd(cls, **kwargs):
         """Get the Repository object implied by the current directory."""
-        repo_path = _git('rev-parse', '--git-dir')
-        workdir = _git('rev-parse', '--show-toplevel') or None
-        return cls(repo_path, workdir)
+        return cls.from_path(os.getcwd(), **kwargs)
+
+    @classmethod
+    def from_path(cls, path, **kwargs):
+        """Get the Repository object containing a directory."""
+        repo_path = _git('rev-parse', '--git-dir', cwd=path)
+        try:
+            workdir = _git('rev-parse', '--show-toplevel', cwd=path) or None
+        except GitError:
+            # Bare repositories have no work tree.
+            workdir = None
+        return cls(os.path.join(path, repo_path), workdir, **kwargs)
+
+    @contextlib.contextmanager
+    def operation(self):
+        """Memoize repository state for the duration of a block.
+
+        Inside the block, HEAD, the ref list, the dirty flag and resolved
+        revisions are each read at most once, until a method that changes
+        them runs. Blocks may be nested; the state is per thread.
+        """
+        outer = getattr(self._local, 'state', None)
+        if outer is None:
+            self._local.state = {}
+        try:
+            yield self
+        finally:
+            if outer is None:
+                self._local.state = None
+
+    def _memo(self, key, compute):
+        state = getattr(self._local, 'state', None)
+        if state is None:
+            return compute()
+        if key not in state:
+            state[key] = compute()
+        return state[key]
+
+    def _invalidate(self):
+        state = getattr(self._local, 'state', None)
+        if state is not None:
+            state.clear()
+
+    def _symbolic_head(self):
+        """Return the ref HEAD points to, or None if it is detached."""
+        return self._memo('head', self._read_symbolic_head)
+
+    def _read_symbolic_head(self):
+        return self._refs.symbolic_head()
 
     @property
     def current_branch(self):
         """Get the current branch."""
-        with _cd(self.path):
-            ref = _git('symbolic-ref', '-q', 'HEAD')
-            if not ref:
-                raise DetachedHead
-            return re.sub('^refs/heads/', '', ref)
+        ref = self._symbolic_head()
+        if not ref:
+            raise DetachedHead
+        return re.sub('^refs/heads/', '', ref)
 
     @property
     def detached_head(self):
         """Return True if in detached HEAD mode.."""
-        with _cd(self.path):
-            ref = _git('symbolic-ref', '-q', 'HEAD')
-            return (not ref)
+        return (not self._symbolic_head())
 
     @property
     def unborn(self):
@@ -129,8 +897,15 @@ class GitExeRepo(object):
     @property
     def refs(self):
         """Get a list of all references."""
-        with _cd(self.path):
-            return _git('for-each-ref', '--format', '%(refname)').split('\n')
+        return [name for name, _ in self.ref_items()]
+
+    def ref_items(self, prefix='refs/'):
+        """Return sorted ``(ref, oid)`` pairs for refs under a prefix."""
+        return self._memo(('ref_items', prefix),
+                          lambda: self._ref_items(prefix))
+
+    def _ref_items(self, prefix):
+        return self._refs.items(prefix)
 
     @property
     def branches(self):
@@ -144,185 +919,1134 @@ class GitExeRepo(object):
     @property
     def dirty(self):
         """Check for modified or untracked files."""
-        with _cd(self.workdir):
-            status = _git('status', '-z').rstrip('\0 ')
-            if not status:
-                return
-            for line in status.split('\0'):
-                wstat = line[1] # status of work tree
+        return self._memo('dirty', self.is_dirty)
+
+    def is_dirty(self, untracked=True):
+        """Check for modified files, and untracked ones unless disabled.
+
+        Status records are read as git produces them, and git is stopped as
+        soon as the first work tree change is seen.
+        """
+        args = ['status', '-z', '--porcelain']
+        if not untracked:
+            args.append('--untracked-files=no')
+        records = _git_iter(*args, sep='\0', cwd=self.workdir)
+        with contextlib.closing(records):
+            for record in records:
+                if len(record) < 2:
+                    continue
+                if record[0] in 'RC':
+                    # Renames and copies are followed by the source path.
+                    next(records, None)
+                wstat = record[1] # status of work tree
                 if wstat not in (' ', '!'):
                     return True
-            return False
+        return False
 
+    @_mutator
     def stage_all(self):
         """Stage all changes in the working directory."""
-        with _cd(self.workdir):
-            _git('add', '--all', '.')
+        _git('add', '--all', '.', cwd=self.workdir)
+
+    def worktree_tree(self):
+        """Write a tree of the whole work tree, leaving the index untouched.
 
+        Changes are staged into a private copy of the index, so the user's
+        index and its cached stat info are not rewritten.
+        """
+        with _private_index(self.path) as env:
+            _git('add', '--all', '.', env=env, cwd=self.workdir)
+            return _git('write-tree', env=env, cwd=self.workdir)
+
+    @_mutator
     def unstage_all(self):
         """Reset the index to the previous commit."""
-        with _cd(self.workdir):
-            head = _git('rev-parse', '--verify', '-q', 'HEAD')
-            if head:
-                _git('read-tree', head)
-            else:
-                _git('read-tree', '--empty')
+        head = self.rev_parse('HEAD')
+        if head:
+            # -m keeps the stat info of entries that do not change.
+            _git('read-tree', '-m', head, cwd=self.workdir)
+        else:
+            _git('read-tree', '--empty', cwd=self.workdir)
 
+    @_mutator
     def discard_all(self):
-        """Discard all changes."""
-        with _cd(self.workdir):
-            self.stage_all()
-            head = _git('rev-parse', '--verify', '-q', 'HEAD')
-            if not head:
-                paths = _git('ls-files', '-z').rstrip('\0 ').split('\0')
-                for path in paths:
-                    os.remove(path)
-            else:
-                _git('reset', '--hard', head)
-
+        """Discard all changes.
+
+        On an unborn branch every file is deleted, and RemovalCounts for
+        them is returned.
+        """
+        head = self.rev_parse('HEAD')
+        if not head:
+            return self._discard_unborn()
+        self.stage_all()
+        self.switch_tree(_git('write-tree', cwd=self.workdir), head)
+
+    def _discard_unborn(self):
+        """Delete all tracked and untracked files, and empty the index."""
+        paths = _git_iter('ls-files', '-z', '--cached', '--others',
+                          '--exclude-standard', sep='\0', cwd=self.workdir)
+        with contextlib.closing(paths):
+            counts = _remove_files(self.workdir, paths)
+        self.unstage_all()
+        return counts
+
+    @_mutator
+    def switch_tree(self, old, new):
+        """Move the index and work tree from tree-ish ``old`` to ``new``.
+
+        A two-way `read-tree -m -u` merge only rewrites the paths that differ
+        between the two, and keeps the stat info of every other index entry.
+        An ``old`` of None stands for the empty tree. Raises GitError, and
+        changes nothing, if local changes would be overwritten.
+        """
+        _git_nostrip('read-tree', '-m', '-u', old or self.empty_tree(), new,
+                     cwd=self.workdir)
+
+    def empty_tree(self):
+        """Return the oid of the empty tree in this repository."""
+        if self._empty_tree is None:
+            self._empty_tree = _git(*_EMPTY_TREE_ARGS, cwd=self.path)
+        return self._empty_tree
+
+    @_mutator
+    def detach_head(self, oid):
+        """Point HEAD directly at a commit, leaving the index and work tree."""
+        _git('update-ref', '--no-deref', 'HEAD', oid, cwd=self.path)
+
+    @_mutator
     def safe_checkout(self, ref):
         """Update a clean work tree to match a reference."""
         if self.dirty:
             raise DirtyWorkTree
-        with _cd(self.workdir):
-            if not _git('rev-parse', '--verify', '-q', ref):
-                raise InvalidRef
-            _git('checkout', '-q', ref)
-
-    def commit(self, message, ref=None):
-        """Create a commit."""
-        with _cd(self.path):
-            tree = _git('write-tree')
-            prev_commit = _git('rev-parse', '--verify', '-q', 'HEAD')
-            ref = ref or _git('symbolic-ref', '-q', 'HEAD')
-            args = ['commit-tree', tree, '-m', message]
-            if prev_commit:
-                args += ['-p', prev_commit]
-            commit = _git(*args)
-            if ref:
-                _git('update-ref', ref, commit)
-            return commit
-
+        if not self.rev_parse(ref):
+            raise InvalidRef
+        _git('checkout', '-q', ref, cwd=self.workdir)
+
+    @_mutator
+    def commit(self, message, ref=None, create=False, tree=None):
+        """Create a commit.
+
+        The commit records ``tree`` if given, or else the current index. If
+        ``create`` is True, raise InvalidRef instead of moving ``ref`` when it
+        already exists.
+        """
+        tree = tree or _git('write-tree', cwd=self.path)
+        prev_commit = self.rev_parse('HEAD')
+        ref = ref or self._symbolic_head()
+        args = ['commit-tree', tree, '-m', message]
+        if prev_commit:
+            args += ['-p', prev_commit]
+        commit = _git(*args, cwd=self.path)
+        if not _RefStore.OID.match(commit):
+            raise GitError(commit)
+        if ref:
+            transaction = self.ref_transaction()
+            if create:
+                transaction.create(ref, commit)
+            else:
+                transaction.update(ref, commit)
+            try:
+                transaction.commit()
+            except GitError:
+                if create and self._refs.resolve(ref):
+                    raise InvalidRef("reference already exists")
+                raise
+        return commit
+
+    @_mutator
     def reset(self, ref, reset_type='mixed'):
         """Reset to a previous commit (as `git reset`)."""
         if reset_type not in ('soft', 'hard', 'mixed'):
             raise ValueError('invalid reset type')
         type_arg = '--' + reset_type
-        with _cd(self.workdir):
-            if not self.rev_parse(ref):
-                raise InvalidRef
-            if self.unborn:
-                raise UnbornBranch
-            _git('reset', type_arg, ref)
+        if not self.rev_parse(ref):
+            raise InvalidRef
+        if self.unborn:
+            raise UnbornBranch
+        _git('reset', type_arg, ref, cwd=self.workdir)
 
+    @_mutator
     def set_head(self, branch, force=False):
         """Set HEAD to a given branch."""
-        with _cd(self.path):
-            ref = 'refs/heads/' + branch
-            if not force and not self.rev_parse(ref):
-                raise InvalidRef
-            _git('symbolic-ref', 'HEAD', ref)
+        ref = 'refs/heads/' + branch
+        if not force and not self.rev_parse(ref):
+            raise InvalidRef
+        _git('symbolic-ref', 'HEAD', ref, cwd=self.path)
 
     def rev_parse(self, ref):
         """Return the oid of the reference, or an empty string if error."""
-        with _cd(self.path):
-            return _git('rev-parse', '--verify', '-q', ref)
+        return self._memo(('rev_parse', ref), lambda: self._rev_parse(ref))
+
+    def _rev_parse(self, ref):
+        oid = self._refs.rev_parse(ref)
+        if oid is not None:
+            return oid
+        obj = self._revs.query(ref)
+        return obj[0] if obj else ''
+
+    def ref_transaction(self):
+        """Return a RefTransaction for batching ref updates."""
+        return RefTransaction(self.path, on_commit=self._invalidate)
+
+    def pack_refs(self):
+        """Pack all refs into packed-refs and remove the loose files."""
+        _git('pack-refs', '--all', '--prune', cwd=self.path)
+
+    def gc(self):
+        """Run `git gc` to drop unreachable objects and repack."""
+        _git('gc', '--quiet', cwd=self.path)
+
+    def create_bundle(self, filename, revs):
+        """Write a `git bundle` of the given rev-list arguments.
+
+        ``revs`` are refs to include and ``^oid`` exclusions, which become
+        the bundle's prerequisites. Raises GitError if git fails.
+        """
+        _git_nostrip('bundle', 'create', os.path.abspath(filename), '--stdin',
+                     input=''.join(rev + '\n' for rev in revs), cwd=self.path)
+
+    def bundle_heads(self, filename):
+        """Return the ``(ref, oid)`` pairs recorded in a bundle."""
+        return self._bundle_heads('list-heads', filename)
+
+    def unbundle(self, filename):
+        """Copy a bundle's objects into the repository without creating any
+        refs, returning its ``(ref, oid)`` heads.
+
+        Raises GitError if the bundle's prerequisites are missing.
+        """
+        return self._bundle_heads('unbundle', filename)
+
+    def _bundle_heads(self, command, filename):
+        heads = []
+        for line in _git_iter('bundle', command, os.path.abspath(filename),
+                              cwd=self.path):
+            oid, ref = line.split(' ', 1)
+            heads.append((ref, oid))
+        return heads
+
+    def ref_infos(self, prefix):
+        """Yield RefInfo records for refs under a prefix, newest first.
+
+        Refs with the same date are ordered by the numbers in their names,
+        highest first, so later snapshots come before earlier ones.
+        """
+        args = _REF_INFO_ARGS + (prefix,)
+        for line in _git_iter(*args, cwd=self.path):
+            yield _parse_ref_info(line)
 
     def commit_info(self, ref):
         """Return info about a given commit."""
-        oid = _git('rev-parse', '--verify', '-q', ref)
+        oid = self.rev_parse(ref + '^{commit}')
+        if not oid:
+            raise InvalidRef
+        info = self._commits.get(oid)
+        if info is None and self._commit_store is not None:
+            info = self._commit_store.get(oid)
+        if info is None:
+            info = self._read_commit(oid)
+            if self._commit_store is not None:
+                self._commit_store.put(oid, info)
+        self._commits.put(oid, info)
+        return info
+
+    def _read_commit(self, oid):
+        obj = self._objects.query(oid)
+        if not obj:
+            raise InvalidRef
+        return _parse_commit(obj[2])
+
+
+def _parse_git_date(value):
+    """Parse a GIT_AUTHOR_DATE or GIT_COMMITTER_DATE value as git does.
+
+    Accepts git's internal format (``[@]seconds [+hhmm]``), ISO 8601 and
+    RFC 2822 dates. Returns ``(seconds, offset)``, with the UTC offset in
+    minutes. Raises GitError for anything else.
+    """
+    import calendar
+    import email.utils
+    value = value.strip()
+    match = re.match(r'@?(\d+)(?: ([+-])(\d\d)(\d\d))?$', value)
+    if match:
+        seconds, sign, hours, minutes = match.groups()
+        offset = 0
+        if sign is not None:
+            offset = int(hours) * 60 + int(minutes)
+            offset = -offset if sign == '-' else offset
+        return int(seconds), offset
+    match = re.match(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d))?'
+                     r' ?(Z|([+-])(\d\d):?(\d\d))?$', value)
+    if match:
+        fields = [int(field or 0) for field in match.groups()[:6]]
+        local = fields + [0, 0, -1]
+        if match.group(7) is None:
+            seconds = int(time.mktime(tuple(local)))
+            return seconds, _local_offset(seconds)
+        offset = 0
+        if match.group(7) != 'Z':
+            offset = int(match.group(9)) * 60 + int(match.group(10))
+            offset = -offset if match.group(8) == '-' else offset
+        return calendar.timegm(tuple(local)) - offset * 60, offset
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is not None:
+        return int(email.utils.mktime_tz(parsed)), (parsed[9] or 0) // 60
+    raise GitError("invalid date format: {}".format(value))
+
+
+def _local_offset(seconds):
+    """Return the local UTC offset, in minutes, at a given time."""
+    local = time.localtime(seconds)
+    if local.tm_isdst > 0 and time.daylight:
+        return -time.altzone // 60
+    return -time.timezone // 60
+
+
+def _pygit2_errors(method):
+    """Raise pygit2's errors from a Pygit2Repo method as GitError."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except pygit2.GitError as error:
+            raise GitError(str(error))
+    return wrapper
+
+
+class Pygit2Repo(GitExeRepo):
+    """Git repository backed by libgit2, through pygit2.
+
+    Everyday operations run in-process. Anything not overridden here falls
+    back to the Git executable.
+    """
+
+    WT_CHANGED = ('GIT_STATUS_WT_NEW', 'GIT_STATUS_WT_MODIFIED',
+                  'GIT_STATUS_WT_DELETED', 'GIT_STATUS_WT_TYPECHANGE',
+                  'GIT_STATUS_WT_RENAMED')
+
+    def __init__(self, path, workdir=None, **kwargs):
+        super(Pygit2Repo, self).__init__(path, workdir, **kwargs)
+        self._repo = pygit2.Repository(self.path)
+        # libgit2 shares one in-memory index per repository object.
+        self._index_lock = threading.RLock()
+
+    @classmethod
+    @_pygit2_errors
+    def from_path(cls, path, **kwargs):
+        """Get the Repository object containing a directory."""
+        repo_path = pygit2.discover_repository(os.path.abspath(path))
+        if not repo_path:
+            raise NotARepository("directory is not part of a repository")
+        repo = pygit2.Repository(repo_path)
+        workdir = repo.workdir.rstrip('/') if repo.workdir else None
+        return cls(repo_path.rstrip('/'), workdir, **kwargs)
+
+    def _index(self):
+        index = self._repo.index
+        index.read(False)
+        return index
+
+    def _signature(self, kind):
+        """Build an author or committer signature as git would."""
+        name = os.environ.get('GIT_{}_NAME'.format(kind))
+        email = os.environ.get('GIT_{}_EMAIL'.format(kind))
+        if name is None or email is None:
+            default = self._repo.default_signature
+            name = default.name if name is None else name
+            email = default.email if email is None else email
+        date = os.environ.get('GIT_{}_DATE'.format(kind))
+        if date is None:
+            return pygit2.Signature(name, email)
+        seconds, offset = _parse_git_date(date)
+        return pygit2.Signature(name, email, seconds, offset)
+
+    @_pygit2_errors
+    def _read_symbolic_head(self):
+        head = self._repo.lookup_reference('HEAD')
+        return head.target if isinstance(head.target, str) else None
+
+    def _ref_items(self, prefix):
+        pairs = []
+        for name in sorted(self._repo.references):
+            if not name.startswith(prefix):
+                continue
+            try:
+                oid = self._repo.lookup_reference(name).resolve().target
+            except (KeyError, pygit2.GitError):
+                continue
+            pairs.append((name, str(oid)))
+        return pairs
+
+    @_pygit2_errors
+    def is_dirty(self, untracked=True):
+        """Check for modified files, and untracked ones unless disabled."""
+        # save() stages into the shared in-memory index while it builds a
+        # tree, so status must not run in the middle of that.
+        with self._index_lock:
+            status = self._repo.status(
+                untracked_files='normal' if untracked else 'no')
+        changed = 0
+        for name in self.WT_CHANGED:
+            changed |= getattr(pygit2, name, 0)
+        return any(flags & changed for flags in status.values())
+
+    def _stage_all(self, index):
+        index.add_all()
+        for entry in list(index):
+            if not os.path.lexists(os.path.join(self.workdir, entry.path)):
+                index.remove(entry.path)
+
+    @_mutator
+    @_pygit2_errors
+    def stage_all(self):
+        """Stage all changes in the working directory."""
+        with self._index_lock:
+            index = self._index()
+            self._stage_all(index)
+            index.write()
+
+    @_pygit2_errors
+    def worktree_tree(self):
+        """Write a tree of the whole work tree, leaving the index untouched.
+
+        Changes are staged into the in-memory index only, which is then
+        reloaded from disk.
+        """
+        with self._index_lock:
+            index = self._index()
+            try:
+                self._stage_all(index)
+                return str(index.write_tree())
+            finally:
+                index.read(True)
+
+    @_mutator
+    @_pygit2_errors
+    def unstage_all(self):
+        """Reset the index to the previous commit."""
+        head = self.rev_parse('HEAD')
+        with self._index_lock:
+            index = self._index()
+            if head:
+                index.read_tree(self._repo[head].peel(pygit2.Tree))
+            else:
+                index.clear()
+            index.write()
+
+    @_mutator
+    @_pygit2_errors
+    def discard_all(self):
+        """Discard all changes.
+
+        On an unborn branch every file is deleted, and RemovalCounts for
+        them is returned.
+        """
+        head = self.rev_parse('HEAD')
+        if not head:
+            return self._discard_unborn()
+        self.stage_all()
+        self._repo.reset(pygit2.Oid(hex=head), pygit2.GIT_RESET_HARD)
+
+    @_mutator
+    @_pygit2_errors
+    def safe_checkout(self, ref):
+        """Update a clean work tree to match a reference."""
+        if self.dirty:
+            raise DirtyWorkTree
+        oid = self.rev_parse(ref)
         if not oid:
             raise InvalidRef
-        raw_commit = _git_nostrip('cat-file', '-p', oid)
-
-        paragraphs = raw_commit.split('\n\n')
-        lines = paragraphs[0].split('\n')
-        message = '\n\n'.join(paragraphs[1:])
-        tree = lines.pop(0).split(' ')[1]
-        parents = []
-        while lines[0].startswith('parent'):
-            parent = lines.pop(0).split(' ')[1]
-            parents.append(parent)
-        raw_author = lines.pop(0)
-        author_match = re.match('^.*? (.*) (\d+) .*$', raw_author)
-        author, author_timestamp = author_match.groups()
-
-        return CommitInfo(message=message,
-                          time=int(author_timestamp),
-                          tree=tree,
-                          parents=parents)
+        branch = 'refs/heads/' + ref
+        if self._repo.references.get(branch) is not None:
+            self._repo.checkout(branch)
+        else:
+            commit = self._repo[oid].peel(pygit2.Commit)
+            self._repo.checkout_tree(commit)
+            self._repo.set_head(commit.id)
+
+    @_mutator
+    @_pygit2_errors
+    def commit(self, message, ref=None, create=False, tree=None):
+        """Create a commit.
+
+        The commit records ``tree`` if given, or else the current index. If
+        ``create`` is True, raise InvalidRef instead of moving ``ref`` when it
+        already exists.
+        """
+        if not tree:
+            with self._index_lock:
+                tree = str(self._index().write_tree())
+        prev_commit = self.rev_parse('HEAD')
+        if ref is None:
+            ref = self._symbolic_head()
+        if not message.endswith('\n'):
+            message += '\n'
+        parents = [pygit2.Oid(hex=prev_commit)] if prev_commit else []
+        commit = self._repo.create_commit(
+            None, self._signature('AUTHOR'), self._signature('COMMITTER'),
+            message, pygit2.Oid(hex=tree), parents)
+        if ref:
+            try:
+                self._repo.references.create(ref, commit, force=not create)
+            except pygit2.AlreadyExistsError:
+                raise InvalidRef("reference already exists")
+            except (ValueError, pygit2.GitError) as error:
+                raise GitError(str(error))
+        return str(commit)
+
+    @_mutator
+    @_pygit2_errors
+    def reset(self, ref, reset_type='mixed'):
+        """Reset to a previous commit (as `git reset`)."""
+        reset_types = {
+            'soft': pygit2.GIT_RESET_SOFT,
+            'mixed': pygit2.GIT_RESET_MIXED,
+            'hard': pygit2.GIT_RESET_HARD,
+        }
+        if reset_type not in reset_types:
+            raise ValueError('invalid reset type')
+        oid = self.rev_parse(ref)
+        if not oid:
+            raise InvalidRef
+        if self.unborn:
+            raise UnbornBranch
+        self._repo.reset(pygit2.Oid(hex=oid), reset_types[reset_type])
+
+    @_mutator
+    @_pygit2_errors
+    def set_head(self, branch, force=False):
+        """Set HEAD to a given branch."""
+        ref = 'refs/heads/' + branch
+        if not force and not self.rev_parse(ref):
+            raise InvalidRef
+        self._repo.references.create('HEAD', ref, force=True)
+
+    def _rev_parse(self, ref):
+        try:
+            return str(self._repo.revparse_single(ref).id)
+        except (KeyError, ValueError, pygit2.GitError):
+            return ''
+
+    def ref_infos(self, prefix):
+        """Yield RefInfo records for refs under a prefix, newest first."""
+        infos = []
+        for ref, oid in self.ref_items(prefix):
+            try:
+                commit = self._repo[oid].peel(pygit2.Commit)
+            except (KeyError, ValueError, pygit2.GitError):
+                continue
+            subject = commit.message.split('\n', 1)[0]
+            infos.append(RefInfo(ref=ref, oid=oid, time=commit.author.time,
+                                 subject=subject))
+        infos.sort(key=lambda info: (info.time, _version_key(info.ref)),
+                   reverse=True)
+        for info in infos:
+            yield info
+
+    @_pygit2_errors
+    def _read_commit(self, oid):
+        commit = self._repo[oid]
+        return CommitInfo(message=commit.message,
+                          time=commit.author.time,
+                          parents=[str(p) for p in commit.parent_ids],
+                          tree=str(commit.tree_id))
+
+
+def _version_key(name):
+    """Sort key comparing the runs of digits in a name as numbers."""
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', name)]
+
+
+SNAPSHOT_PREFIX = 'refs/hidden/tags/twit/'
+
+
+def _snapshot_message(branch):
+    """Return the commit message recorded in a snapshot."""
+    return json.dumps({
+        'branch': branch,
+        'note': 'Tag auto-generated by Twit.',
+    })
+
+
+def _snapshot_origin(cinfo):
+    """Return the ``(parent, branch)`` a snapshot commit was taken from."""
+    if len(cinfo.parents) > 1:
+        raise InvalidSnapshot('multiple parent commits')
+    elif len(cinfo.parents) == 1:
+        parent = cinfo.parents[0]
+    else:
+        parent = None
+    try:
+        sinfo = json.loads(cinfo.message)
+    except ValueError:
+        raise InvalidSnapshot('message is invalid json')
+    return parent, sinfo.get('branch', None)
+
+
+def _taken_from(cinfo, parent, branch):
+    """Check whether a snapshot commit was taken from ``parent`` (None for
+    an unborn branch) on ``branch``."""
+    return (cinfo.message.strip() == _snapshot_message(branch) and
+            cinfo.parents == ([parent] if parent else []))
+
+
+def _next_snapshot_number(snapshots):
+    """Return the number after the highest of the given snapshot refs."""
+    indices = [
+        int(ref[len(SNAPSHOT_PREFIX):])
+        for ref in snapshots
+        if ref[len(SNAPSHOT_PREFIX):].isdigit()
+    ]
+    return max(indices or [0]) + 1
+
+
+RETENTION_PERIODS = (
+    ('hourly', 60 * 60),
+    ('daily', 24 * 60 * 60),
+    ('weekly', 7 * 24 * 60 * 60),
+)
+
+
+def _retained_snapshots(infos, now, keep_last=0, **periods):
+    """Return the refs a retention policy keeps, given newest-first infos.
+
+    The newest ``keep_last`` snapshots are always kept. For each period in
+    RETENTION_PERIODS, ``<period>=N`` keeps the newest snapshot in each of
+    the last N periods, e.g. ``hourly=24, daily=30`` keeps one snapshot per
+    hour for a day and one per day for a month.
+    """
+    keep = set(info.ref for info in infos[:keep_last])
+    for name, seconds in RETENTION_PERIODS:
+        count = periods.get(name) or 0
+        buckets = set()
+        for info in infos:
+            # Periods are counted back from now, not from calendar hours.
+            bucket = max(now - info.time, 0) // seconds
+            if bucket >= count:
+                break
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(info.ref)
+    return keep
+
+
+def _read_snapshot_counter(path):
+    """Return the next snapshot number stored under a git directory.
+
+    ``path`` is the common git directory, which holds the snapshot refs and
+    is shared by all linked worktrees.
+    """
+    try:
+        with io.open(os.path.join(path, 'twit', 'next-snapshot')) as rfile:
+            return int(rfile.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_snapshot_counter(path, index):
+    """Atomically replace the snapshot counter under a git directory."""
+    counter = os.path.join(path, 'twit', 'next-snapshot')
+    if not os.path.isdir(os.path.dirname(counter)):
+        os.makedirs(os.path.dirname(counter))
+    temp = '{}.{}.tmp'.format(counter, os.getpid())
+    with io.open(temp, 'w') as wfile:
+        wfile.write(u'{}\n'.format(index))
+    getattr(os, 'replace', os.rename)(temp, counter)
+
+
+class _IgnoredDirs(object):
+    """The directories git ignores in a work tree, which watchers skip.
+
+    Ignored directories present at startup are found with one `git
+    ls-files`; directories created later are checked with `git
+    check-ignore` when first seen.
+    """
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        candidates = [path.rstrip('/') for path in _git_iter(
+            'ls-files', '-z', '--others', '--ignored', '--exclude-standard',
+            '--directory', sep='\0', cwd=workdir) if path.endswith('/')]
+        # ls-files also lists directories holding only ignored files, which
+        # must still be watched for new files.
+        self._ignored = set(os.path.join(workdir, path)
+                            for path in self._check(candidates))
+
+    def _check(self, paths):
+        """Return those of ``paths``, relative to the work tree, that an
+        ignore pattern matches."""
+        if not paths:
+            return set()
+        try:
+            output = _git_nostrip(
+                'check-ignore', '-z', '--stdin', '--verbose', '--non-matching',
+                input=''.join(path + '\0' for path in paths),
+                cwd=self.workdir)
+        except GitError as error:
+            if str(error):
+                raise
+            # check-ignore exits with 1, silently, when nothing matches.
+            return set()
+        fields = output.split('\0')
+        ignored = set()
+        for index in range(0, len(fields) - 3, 4):
+            source, _, pattern, path = fields[index:index + 4]
+            if source and not pattern.startswith('!'):
+                ignored.add(path)
+        return ignored
+
+    def __contains__(self, path):
+        return path in self._ignored
+
+    def check(self, path):
+        """Check whether a directory created since startup is ignored."""
+        if path not in self._ignored and \
+                self._check([os.path.relpath(path, self.workdir)]):
+            self._ignored.add(path)
+        return path in self._ignored
+
+
+class _PollWatcher(object):
+    """Detect work tree changes by rescanning it every ``interval`` seconds.
+
+    Directory listings are cached and only re-read when the directory's own
+    mtime changes, so a scan of an unchanged tree costs one ``lstat`` per
+    entry and no ``listdir`` calls. Directories in ``ignored`` (an
+    _IgnoredDirs) are not scanned.
+    """
+
+    def __init__(self, root, interval=1.0, ignore=('.git',), ignored=None):
+        self.root = root
+        self.interval = interval
+        self.ignore = set(ignore)
+        self.ignored = ignored
+        self._listings = {}
+        self._files = {}
+        self._scan()
+
+    @staticmethod
+    def _signature(stat_result):
+        return (stat_result.st_mtime, stat_result.st_size,
+                stat_result.st_ino)
+
+    def _scan(self):
+        """Rescan the tree, returning True if anything changed."""
+        changed = False
+        initial = not self._listings
+        listings = {}
+        files = {}
+        pending = [self.root]
+        while pending:
+            dirname = pending.pop()
+            try:
+                signature = self._signature(os.lstat(dirname))
+                cached = self._listings.get(dirname)
+                if cached is None or cached[0] != signature:
+                    changed = True
+                    cached = (signature, os.listdir(dirname))
+            except OSError:
+                changed = True
+                continue
+            listings[dirname] = cached
+            for name in cached[1]:
+                if name in self.ignore:
+                    continue
+                path = os.path.join(dirname, name)
+                try:
+                    stat_result = os.lstat(path)
+                except OSError:
+                    changed = True
+                    continue
+                if stat.S_ISDIR(stat_result.st_mode):
+                    if not self._ignored_dir(path, initial):
+                        pending.append(path)
+                else:
+                    files[path] = self._signature(stat_result)
+                    if self._files.get(path) != files[path]:
+                        changed = True
+        changed = changed or len(listings) != len(self._listings)
+        self._listings = listings
+        self._files = files
+        return changed
+
+    def _ignored_dir(self, path, initial):
+        if self.ignored is None or path in self._listings:
+            return False
+        return path in self.ignored if initial else self.ignored.check(path)
+
+    def wait(self, timeout=None):
+        """Return True once the tree changes, or False after ``timeout``."""
+        deadline = None if timeout is None else _clock() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - _clock())
+            if delay > 0:
+                time.sleep(delay)
+            if self._scan():
+                return True
+            if deadline is not None and _clock() >= deadline:
+                return False
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher(object):
+    """Detect work tree changes with inotify, watching every directory
+    except those in ``ignored`` (an _IgnoredDirs).
+
+    Raises OSError if the inotify watch limit is reached at startup. If it
+    is reached later, the watcher switches to polling every ``interval``
+    seconds.
+    """
+
+    def __init__(self, root, ignore=('.git',), interval=1.0, ignored=None):
+        flags = inotify_simple.flags
+        self.mask = (flags.MODIFY | flags.ATTRIB | flags.CREATE |
+                     flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO |
+                     flags.DELETE_SELF)
+        self.root = root
+        self.ignore = set(ignore)
+        self.interval = interval
+        self.ignored = ignored
+        self._inotify = inotify_simple.INotify()
+        self._dirs = {}
+        self._poller = None
+        try:
+            self._add_tree(root)
+        except OSError:
+            self._inotify.close()
+            raise
+
+    def _skip(self, path, new):
+        if self.ignored is None:
+            return False
+        return self.ignored.check(path) if new else path in self.ignored
+
+    def _add_tree(self, root, new=False):
+        """Watch a directory and those below it, raising OSError if the
+        watch limit is reached."""
+        if self._skip(root, new):
+            return
+        for dirname, subdirs, _ in os.walk(root):
+            subdirs[:] = [name for name in subdirs if name not in self.ignore
+                          and not self._skip(os.path.join(dirname, name), new)]
+            try:
+                self._dirs[self._inotify.add_watch(dirname, self.mask)] = \
+                    dirname
+            except OSError as error:
+                # Directories removed since the walk listed them are fine.
+                if error.errno == errno.ENOSPC:
+                    raise
+
+    def wait(self, timeout=None):
+        """Return True once the tree changes, or False after ``timeout``."""
+        if self._poller is not None:
+            return self._poller.wait(timeout)
+        flags = inotify_simple.flags
+        deadline = None if timeout is None else _clock() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(int((deadline - _clock()) * 1000), 0)
+            changed = False
+            for event in self._inotify.read(timeout=remaining):
+                if event.mask & flags.IGNORED:
+                    self._dirs.pop(event.wd, None)
+                elif event.name in self.ignore:
+                    continue
+                elif event.mask & flags.ISDIR and \
+                        event.mask & (flags.CREATE | flags.MOVED_TO):
+                    parent = self._dirs.get(event.wd)
+                    if parent is not None and not self._watch_new(
+                            os.path.join(parent, event.name)):
+                        return True
+                changed = True
+            if changed:
+                return True
+            if deadline is not None and _clock() >= deadline:
+                return False
+
+    def _watch_new(self, path):
+        """Watch a new directory, switching to polling and returning False
+        if the watch limit is reached."""
+        try:
+            self._add_tree(path, new=True)
+            return True
+        except OSError:
+            self._inotify.close()
+            self._poller = _PollWatcher(self.root, self.interval, self.ignore,
+                                        self.ignored)
+            return False
+
+    def close(self):
+        self._inotify.close()
+
+
+def _watcher(root, interval=1.0, poll=False):
+    """Return an inotify watcher for a tree if possible, else a poller.
+
+    Directories git ignores are not watched.
+    """
+    ignored = _IgnoredDirs(root)
+    if INOTIFY and not poll:
+        try:
+            return _InotifyWatcher(root, interval=interval, ignored=ignored)
+        except OSError:
+            pass
+    return _PollWatcher(root, interval, ignored=ignored)
+
+
+def _operation(method):
+    """Run a repository method inside one memoizing ``operation()``."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.operation():
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class TwitMixin(object):
     """Non-backend-specific Twit methods."""
 
+    snapshot_prefix = SNAPSHOT_PREFIX
+
     @property
     def snapshots(self):
         """Return a list of Twit snaphsots."""
-        return [
-            ref for ref in self.refs
-            if ref.startswith('refs/hidden/tags/twit/')
-        ]
+        return [ref for ref, _ in self.ref_items(self.snapshot_prefix)]
+
+    def snapshot_index(self):
+        """Return a mapping of snapshot commit oids to snapshot refs."""
+        return dict(
+            (oid, ref) for ref, oid in self.ref_items(self.snapshot_prefix)
+        )
+
+    def snapshot_infos(self, limit=None, since=None):
+        """Yield RefInfo records for snapshots, newest first.
+
+        Stops after ``limit`` records, or at the first snapshot older than
+        the ``since`` timestamp.
+        """
+        with contextlib.closing(self.ref_infos(self.snapshot_prefix)) as infos:
+            for count, info in enumerate(infos):
+                if limit is not None and count >= limit:
+                    break
+                if since is not None and info.time < since:
+                    break
+                yield info
 
     @property
     def snapshot_commits(self):
-        """Return a list of commit hashes referring to Twit snapshots."""
-        return [
-            self.rev_parse(snapshot)
-            for snapshot in self.snapshots
-        ]
+        """Return a set of commit hashes referring to Twit snapshots."""
+        return set(self.snapshot_index())
+
+    def _next_snapshot_index(self):
+        """Return the next free snapshot number.
+
+        The number is read from a counter file kept under the git directory.
+        If the counter is missing, it is rebuilt from a single listing of the
+        existing snapshots.
+        """
+        index = _read_snapshot_counter(self._refs.common_path)
+        if index is not None:
+            return index
+        return _next_snapshot_number(self.snapshots)
+
+    def _latest_snapshot(self, index, parent, branch):
+        """Return the snapshot numbered just before ``index`` if it was taken
+        from ``parent`` on ``branch``.
+
+        Only that one snapshot is read, so the cost does not grow with the
+        number of snapshots. Returns a ``(ref, CommitInfo)`` pair, or None.
+        """
+        ref = '{}{}'.format(self.snapshot_prefix, index - 1)
+        try:
+            cinfo = self.commit_info(ref)
+        except InvalidRef:
+            return None
+        return (ref, cinfo) if _taken_from(cinfo, parent, branch) else None
 
+    @_operation
     def save(self):
-        """Save a snapshot of the working directory."""
-        self.stage_all()
-        index = 1
-        while 'refs/hidden/tags/twit/{}'.format(index) in self.refs:
-            index += 1
-        ref = 'refs/hidden/tags/twit/{}'.format(index)
+        """Save a snapshot of the working directory.
+
+        If the work tree matches the previous snapshot, and that was taken
+        from the same branch and commit, no new snapshot is made and that
+        one is returned.
+        """
+        tree = self.worktree_tree()
         try:
             branch = self.current_branch
         except DetachedHead:
             branch = None
-        message = json.dumps({
-            'branch': branch,
-            'note': 'Tag auto-generated by Twit.',
-        })
-        commit = self.commit(message, ref=ref)
-        self.unstage_all()
+        index = self._next_snapshot_index()
+        latest = self._latest_snapshot(index, self.rev_parse('HEAD'), branch)
+        if latest is not None and latest[1].tree == tree:
+            return latest[0]
+        message = _snapshot_message(branch)
+        while True:
+            # Snapshot refs are created, never moved, so a stale counter or a
+            # concurrent save just moves on to the next number.
+            ref = '{}{}'.format(self.snapshot_prefix, index)
+            try:
+                self.commit(message, ref=ref, create=True, tree=tree)
+            except InvalidRef:
+                index += 1
+            else:
+                break
+        _write_snapshot_counter(self._refs.common_path, index + 1)
         return ref
 
+    @_operation
+    def prune_snapshots(self, keep_last=0, hourly=0, daily=0, weekly=0,
+                        now=None, dry_run=False, gc=False):
+        """Delete the snapshots a retention policy does not keep.
+
+        See _retained_snapshots for the policy. Deletions happen in one
+        atomic batch, after which the remaining refs are packed (and, if
+        ``gc`` is True, `git gc` runs). Returns the deleted refs.
+        """
+        if not (keep_last or hourly or daily or weekly):
+            raise ValueError('refusing to prune without a retention policy')
+        now = time.time() if now is None else now
+        infos = list(self.snapshot_infos())
+        keep = _retained_snapshots(infos, now, keep_last=keep_last,
+                                   hourly=hourly, daily=daily, weekly=weekly)
+        doomed = [info for info in infos if info.ref not in keep]
+        if dry_run:
+            return [info.ref for info in doomed]
+        with self.ref_transaction() as transaction:
+            for info in doomed:
+                transaction.delete(info.ref, info.oid)
+        self.pack_refs()
+        if gc:
+            self.gc()
+        return [info.ref for info in doomed]
+
+    def export_snapshots(self, filename, since=()):
+        """Write snapshots to a `git bundle` file.
+
+        ``since`` names earlier exports; only the snapshots missing from all
+        of them are written, without the objects they already hold, so
+        importing the result needs those bundles imported first. Returns the
+        exported refs. No file is written if there are none.
+        """
+        exclude = set()
+        for previous in since:
+            exclude.update(oid for _, oid in self.bundle_heads(previous))
+        refs = [ref for ref, oid in self.ref_items(self.snapshot_prefix)
+                if oid not in exclude]
+        if refs:
+            prerequisites = ['^' + oid for oid in sorted(exclude)
+                             if self.rev_parse(oid + '^{commit}')]
+            self.create_bundle(filename, refs + prerequisites)
+        return refs
+
+    @_operation
+    def import_snapshots(self, filename):
+        """Add the snapshots from a bundle written by export_snapshots.
+
+        The snapshots are numbered after the existing ones, keeping their
+        order, and registered in one ref transaction. Snapshots already in
+        the repository are skipped. Returns the new refs.
+        """
+        known = set(oid for _, oid in self.ref_items(self.snapshot_prefix))
+        oids = []
+        heads = sorted(self.unbundle(filename),
+                       key=lambda head: _version_key(head[0]))
+        for ref, oid in heads:
+            if ref.startswith(SNAPSHOT_PREFIX) and oid not in known:
+                known.add(oid)
+                oids.append(oid)
+        if not oids:
+            return []
+        index = self._next_snapshot_index()
+        while True:
+            refs = ['{}{}'.format(self.snapshot_prefix, index + offset)
+                    for offset in range(len(oids))]
+            transaction = self.ref_transaction()
+            for ref, oid in zip(refs, oids):
+                transaction.create(ref, oid)
+            try:
+                transaction.commit()
+                break
+            except GitError:
+                # The counter was stale or a snapshot was saved meanwhile;
+                # number after the highest existing snapshot instead.
+                taken = _next_snapshot_number(self.snapshots)
+                if taken <= index:
+                    raise
+                index = taken
+        _write_snapshot_counter(self._refs.common_path, index + len(oids))
+        return refs
+
+    def watch(self, debounce=1.0, interval=1.0, poll=False, callback=None,
+              errback=None, stop=None):
+        """Save a snapshot after each burst of changes to the work tree.
+
+        A snapshot is taken once no change has been seen for ``debounce``
+        seconds. Changes are detected with inotify when it is available
+        (unless ``poll`` is True), otherwise by rescanning the tree every
+        ``interval`` seconds. Each saved ref is passed to ``callback``, and
+        each TwitError from ``save`` to ``errback`` (or raised if there is
+        none). Runs until the ``stop`` event is set.
+        """
+        stop = stop or threading.Event()
+        watcher = _watcher(self.workdir, interval, poll)
+        try:
+            while not stop.is_set():
+                if not watcher.wait(interval):
+                    continue
+                while watcher.wait(debounce) and not stop.is_set():
+                    pass
+                if stop.is_set():
+                    break
+                try:
+                    ref = self.save()
+                except TwitError as error:
+                    if errback is None:
+                        raise
+                    errback(error)
+                else:
+                    if callback is not None:
+                        callback(ref)
+        finally:
+            watcher.close()
+
+    @_operation
     def open_snapshot(self, ref):
         """Open a Twit snapshot."""
         if self.dirty:
             raise DirtyWorkTree
         oid = self.rev_parse(ref)
-        if not oid or oid not in self.snapshot_commits:
+        if not oid or oid not in self.snapshot_index():
             raise InvalidRef("not a Twit snapshot")
+        self._open_snapshot(oid)
+
+    def _open_snapshot(self, oid):
+        """Open a snapshot commit already known to be a Twit snapshot."""
         cinfo = self.commit_info(oid)
-        if len(cinfo.parents) > 1:
-            raise InvalidSnapshot('multiple parent commits')
-        elif len(cinfo.parents) == 1:
-            parent = cinfo.parents[0]
-        else:
-            parent = None
-        try:
-            sinfo = json.loads(cinfo.message)
-        except ValueError:
-            raise InvalidSnapshot('message is invalid json')
-        branch = sinfo.get('branch', None)
+        parent, branch = _snapshot_origin(cinfo)
+        if self.dirty:
+            raise DirtyWorkTree
 
-        # First, checkout the snapshot.
-        self.safe_checkout(oid)
+        # First, move the work tree straight from HEAD to the snapshot, so
+        # only the files that differ between the two are rewritten.
+        self.switch_tree(self.rev_parse('HEAD') or None, oid)
 
         if parent is None:
             # If the snapshot was taken on an unborn branch, set HEAD to a
             # temporary branch and clear the index.
-            self.set_head('twit/snapshot/unborn' + cinfo.time, force=True)
+            self.set_head('twit/snapshot/unborn{}'.format(cinfo.time), force=True)
             self.unstage_all()
         else:
-            # Otherwise, simply reset HEAD and the index to the commit that the
-            # snapshot was taken from.
-            self.reset(parent)
+            # Otherwise, point HEAD and the index at the commit that the
+            # snapshot was taken from, leaving the work tree alone.
+            self.detach_head(parent)
+            self.unstage_all()
 
         if branch is not None:
             branch_commit = self.rev_parse(branch)
@@ -339,6 +2063,7 @@ class TwitMixin(object):
                 # commit, enter detached HEAD mode.
                 pass
 
+    @_operation
     def open(self, ref):
         """Open a branch, commit, or snapshot."""
         if self.dirty:
@@ -349,77 +2074,416 @@ class TwitMixin(object):
             oid = self.rev_parse(ref)
             if not oid:
                 raise InvalidRef
-        if oid in self.snapshot_commits:
-            self.open_snapshot(oid)
+        if oid in self.snapshot_index():
+            self._open_snapshot(oid)
         else:
             self.safe_checkout(ref)
 
+
 class GitExeTwitRepo(GitExeRepo, TwitMixin):
     """Twit repo backed by GitExe."""
 
 
-TwitRepo = GitExeTwitRepo
+class Pygit2TwitRepo(Pygit2Repo, TwitMixin):
+    """Twit repo backed by pygit2."""
 
 
-@click.group()
-def main():
-    """Twit: an easier git frontend.
+_BACKENDS = ('git', 'pygit2')
 
-    For help on a subcommand, run:
 
-        twit help SUBCOMMAND
+def _select_backend():
+    """Pick the Twit repo class, honouring the TWIT_BACKEND variable.
 
+    This runs at import time, so an unknown backend is not an error here;
+    _repo_class reports it once a repository is needed.
     """
+    backend = os.environ.get('TWIT_BACKEND')
+    if backend == 'pygit2' or (backend != 'git' and PYGIT2):
+        return Pygit2TwitRepo
+    return GitExeTwitRepo
+
+
+TwitRepo = _select_backend()
 
 
-@main.command()
-def save():
-    """Take a snapshot of your current work."""
-    repo = TwitRepo.from_cwd()
-    repo.save()
-    click.echo('Snapshot saved.')
+def _repo_class():
+    """Return TwitRepo, checking the TWIT_BACKEND variable.
+
+    Raises TwitError for an unknown backend. If pygit2 was picked
+    automatically but fails to import (for example, when it was built
+    against a different libgit2), falls back to the git backend for good.
+    """
+    global TwitRepo
+    backend = os.environ.get('TWIT_BACKEND')
+    if backend is not None and backend not in _BACKENDS:
+        raise TwitError("unknown TWIT_BACKEND {!r}, expected one of: {}"
+                        .format(backend, ', '.join(_BACKENDS)))
+    if TwitRepo is Pygit2TwitRepo and backend is None:
+        try:
+            importlib.import_module('pygit2')
+        except ImportError:
+            TwitRepo = GitExeTwitRepo
+    return TwitRepo
+
+
+def find_repositories(root):
+    """Return the work trees of the repositories under a directory.
+
+    Directories inside a repository that is found are not searched.
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if '.git' in dirnames or '.git' in filenames:
+            found.append(dirpath)
+            dirnames[:] = []
+        else:
+            dirnames.sort()
+    return found
 
 
-@main.command()
-@click.argument('revision')
-def open(revision):
-    """Open a snapshot or branch."""
-    repo = TwitRepo.from_cwd()
-    if repo.dirty:
-        snapshot = repo.save()
-        repo.discard_all()
+def run_batch(paths, operation, jobs=4):
+    """Run ``operation(repo)`` on many repositories from a thread pool.
+
+    Yields ``(path, result, error)`` tuples as each repository finishes. A
+    failure in one repository is reported as its error and does not stop
+    the others.
+    """
+    from multiprocessing.pool import ThreadPool
+    repo_class = _repo_class()
+
+    def work(path):
+        try:
+            with repo_class.from_path(path) as repo:
+                return path, operation(repo), None
+        except TwitError as error:
+            return path, None, str(error) or error.__class__.__name__
+        except Exception as error:
+            return path, None, '{}: {}'.format(type(error).__name__, error)
+
+    pool = ThreadPool(max(1, jobs))
     try:
-        repo.open(revision)
-    except InvalidRef:
-        click.echo("Invalid revision specified.""")
-        repo.open(snapshot)
-
-
-@main.command()
-def snapshots():
-    """Show a list of snapshots."""
-    repo = TwitRepo.from_cwd()
-    for snapshot in repo.snapshots:
-        oid = repo.rev_parse(snapshot)
-        info = repo.commit_info(snapshot)
-        click.echo('{} at {}'.format(oid[:6],
-            datetime.datetime.fromtimestamp(info.time)))
-
-@main.command('help')
-@click.argument('subcommand', required=False)
-@click.pass_context
-def help_(context, subcommand):
-    """Print help for a subcommand."""
-    if subcommand is None:
-        click.echo(main.get_help(context))
-    else:
-        if subcommand not in main.commands:
-            click.echo("Command '{}' does not exist.\n".format(subcommand))
-            click.echo(main.get_help(context))
-            context.exit(1)
-        command = main.commands[subcommand]
-        click.echo(command.get_help(context))
+        for outcome in pool.imap_unordered(work, paths):
+            yield outcome
+    finally:
+        pool.close()
+        pool.join()
+
+
+class GitProfiler(object):
+    """Collect GitCall records while active, and summarize them."""
+
+    def __init__(self, echo=None):
+        self.calls = []
+        self.echo = echo
+        self.started = None
+        self.duration = None
+
+    def _hook(self, call):
+        self.calls.append(call)
+        if self.echo is not None:
+            self.echo('git: {} ({:.1f} ms, {} bytes, exit {})'.format(
+                ' '.join(call.argv[1:]), call.duration * 1000,
+                call.output_bytes, call.returncode))
+
+    def __enter__(self):
+        self.started = _clock()
+        add_git_hook(self._hook)
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        remove_git_hook(self._hook)
+        self.duration = _clock() - self.started
+
+    def summary(self, command=None):
+        """Return a JSON-serializable summary of the collected calls."""
+        by_subcommand = {}
+        for call in self.calls:
+            name = call.argv[1] if len(call.argv) > 1 else ''
+            stats = by_subcommand.setdefault(
+                name, {'calls': 0, 'processes': 0, 'ms': 0.0, 'bytes': 0})
+            stats['calls'] += 1
+            stats['processes'] += int(call.spawned)
+            stats['ms'] += call.duration * 1000
+            stats['bytes'] += call.output_bytes
+        return {
+            'command': command,
+            'wall_ms': (self.duration or 0) * 1000,
+            'git_calls': len(self.calls),
+            'git_processes': sum(int(call.spawned) for call in self.calls),
+            'git_ms': sum(call.duration for call in self.calls) * 1000,
+            'failed_calls': sum(1 for call in self.calls if call.returncode),
+            'by_subcommand': by_subcommand,
+        }
+
+    def describe(self, command=None):
+        """Return a one-line description, naming the slowest git command."""
+        summary = self.summary(command)
+        text = '{}: {} git calls ({} processes), {:.0f} ms'.format(
+            command or 'twit', summary['git_calls'],
+            summary['git_processes'], summary['wall_ms'])
+        by_subcommand = summary['by_subcommand']
+        if by_subcommand and summary['git_ms']:
+            name = max(by_subcommand, key=lambda n: by_subcommand[n]['ms'])
+            share = by_subcommand[name]['ms'] / summary['git_ms']
+            text += ', {:.0%} in {}'.format(share, name)
+        return text
+
+
+DAEMON_COMMANDS = ('save', 'open', 'snapshots')
+
+# Client environment variables a forwarded command runs with.
+DAEMON_ENV = ('GIT_AUTHOR_NAME', 'GIT_AUTHOR_EMAIL', 'GIT_AUTHOR_DATE',
+              'GIT_COMMITTER_NAME', 'GIT_COMMITTER_EMAIL',
+              'GIT_COMMITTER_DATE', 'EMAIL')
+
+# The repository CLI commands act on; `twit serve` sets its warm one here.
+_cli_repo = None
+
+
+def _get_repo():
+    """Return the repository a CLI command should act on."""
+    if _cli_repo is not None:
+        return _cli_repo
+    return _repo_class().from_cwd()
+
+
+def _find_git_dir(path):
+    """Find the git directory for ``path`` without running git.
+
+    Returns None if there is none, or if GIT_DIR is set and git should
+    decide.
+    """
+    if 'GIT_DIR' in os.environ:
+        return None
+    path = os.path.abspath(path)
+    while True:
+        candidate = os.path.join(path, '.git')
+        if os.path.isdir(candidate):
+            return candidate
+        if os.path.isfile(candidate):
+            with io.open(candidate) as rfile:
+                line = rfile.readline().strip()
+            if line.startswith('gitdir: '):
+                return os.path.normpath(os.path.join(path, line[8:]))
+            return None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _daemon_socket(git_dir):
+    return os.path.join(git_dir, 'twit', 'daemon.sock')
+
+
+def _recv_line(sock):
+    """Read from a socket up to a newline or the end of the stream."""
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return b''.join(chunks).decode('utf-8')
+
+
+def _daemon_request(git_dir, request):
+    """Send a request to the daemon for a repository.
+
+    Returns the decoded reply, or None if no daemon is listening.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(_daemon_socket(git_dir))
+        except socket.error:
+            return None
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        return json.loads(_recv_line(sock))
+    finally:
+        sock.close()
+
+
+def stop_daemon(git_dir):
+    """Stop the daemon for a repository, returning False if none ran."""
+    return _daemon_request(git_dir, {'stop': True}) is not None
+
+
+def _forward_to_daemon(argv):
+    """Run a CLI command in the repository's daemon, if one is running.
+
+    Returns the command's exit status, or None if it must run locally.
+    """
+    if not argv or argv[0] not in DAEMON_COMMANDS:
+        return None
+    git_dir = _find_git_dir(os.getcwd())
+    if git_dir is None:
+        return None
+    env = dict((name, os.environ[name]) for name in DAEMON_ENV
+               if name in os.environ)
+    reply = _daemon_request(git_dir, {'argv': argv, 'cwd': os.getcwd(),
+                                      'env': env})
+    if reply is None:
+        return None
+    sys.stdout.write(reply['output'])
+    sys.stderr.write(reply['errors'])
+    return reply['status']
+
+
+@contextlib.contextmanager
+def _client_state(cwd, env):
+    """Temporarily take on a daemon client's directory and DAEMON_ENV."""
+    old_cwd = os.getcwd()
+    old_env = dict((name, os.environ.get(name)) for name in DAEMON_ENV)
+    try:
+        if env is not None:
+            _set_env(dict((name, env.get(name)) for name in DAEMON_ENV))
+        if cwd is not None:
+            os.chdir(cwd)
+        yield
+    finally:
+        os.chdir(old_cwd)
+        _set_env(old_env)
+
+
+def _set_env(values):
+    """Set environment variables, removing those whose value is None."""
+    for name, value in values.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+class TwitDaemon(object):
+    """Serve CLI commands for one repository over a Unix socket.
+
+    The repository object, with its ref caches and git coprocesses, stays
+    warm between requests. Requests and replies are single JSON lines:
+    ``{"argv": [...], "cwd": ..., "env": {...}}`` runs one of
+    DAEMON_COMMANDS in the client's directory, with its DAEMON_ENV
+    variables, and returns its ``status``, ``output`` and ``errors``;
+    ``{"stop": true}`` shuts the daemon down.
+    """
+
+    def __init__(self, repo, idle_timeout=None):
+        self.repo = repo
+        self.path = _daemon_socket(repo.path)
+        self.idle_timeout = idle_timeout
+
+    def _listen(self):
+        if _daemon_request(self.repo.path, {'ping': True}) is not None:
+            raise TwitError('a daemon is already serving this repository')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        elif not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+            sock.listen(16)
+        except socket.error:
+            sock.close()
+            raise
+        sock.settimeout(self.idle_timeout)
+        return sock
+
+    def serve_forever(self, ready=None):
+        """Handle requests until stopped or idle for ``idle_timeout``.
+
+        ``ready``, if given, is an event set once the socket accepts
+        connections.
+        """
+        sock = self._listen()
+        if ready is not None:
+            ready.set()
+        try:
+            running = True
+            while running:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    break
+                try:
+                    conn.settimeout(None)
+                    running = self._handle(conn)
+                except (ValueError, socket.error):
+                    # A client that hangs up or sends a malformed request
+                    # only loses its own connection.
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            os.remove(self.path)
+
+    def _handle(self, conn):
+        """Answer one request, returning False if the daemon should stop."""
+        request = json.loads(_recv_line(conn))
+        if not isinstance(request, dict):
+            raise ValueError('request is not a JSON object')
+        reply = {'status': 0, 'output': '', 'errors': ''}
+        argv = request.get('argv')
+        if argv is not None and (not argv or argv[0] not in DAEMON_COMMANDS):
+            reply.update(status=2, errors='Error: the daemon only runs '
+                         '{}.\n'.format(', '.join(DAEMON_COMMANDS)))
+        elif argv is not None:
+            reply.update(self.run(argv, cwd=request.get('cwd'),
+                                  env=request.get('env')))
+        conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        return not request.get('stop')
+
+    def run(self, argv, cwd=None, env=None):
+        """Run a CLI command against the warm repository, capturing its
+        output.
+
+        The command runs in ``cwd`` and, if ``env`` is given, with its
+        values for the DAEMON_ENV variables.
+        """
+        global _cli_repo
+        import click
+        from twit_cli import main
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = io.BytesIO() if PY2 else io.StringIO()
+        sys.stderr = io.BytesIO() if PY2 else io.StringIO()
+        _cli_repo = self.repo
+        try:
+            try:
+                with _client_state(cwd, env):
+                    status = main.main(args=list(argv), prog_name='twit',
+                                       standalone_mode=False) or 0
+            except click.ClickException as error:
+                error.show()
+                status = error.exit_code
+            except click.Abort:
+                status = 1
+            except Exception as error:
+                # One failing command must not take the daemon down.
+                click.echo('Error: {}: {}'.format(type(error).__name__, error),
+                           err=True)
+                status = 1
+            return {'status': status, 'output': sys.stdout.getvalue(),
+                    'errors': sys.stderr.getvalue()}
+        finally:
+            _cli_repo = None
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+def run(argv=None):
+    """Command line entry point, using a running daemon when possible."""
+    argv = sys.argv[1:] if argv is None else argv
+    status = _forward_to_daemon(argv)
+    if status is None:
+        from twit_cli import main
+        main(args=argv, prog_name='twit')
+    sys.exit(status)
 
 
 if __name__ == '__main__':
-    main()
+    # Let twit_cli share this module rather than importing a second copy.
+    sys.modules.setdefault('twit', sys.modules[__name__])
+    run()
@@ -0,0 +1,274 @@
+"""asyncio interface to Twit, for driving many repositories at once.
+
+Requires Python 3.
+"""
+import os
+import asyncio
+import tempfile
+
+from twit import (SNAPSHOT_PREFIX, DirtyWorkTree, InvalidRef, GitError,
+        NotARepository, _LRUCache, _RefStore, _EMPTY_TREE_ARGS, _REF_INFO_ARGS,
+        _RecordSplitter, _git_error, _not_found, _parse_commit,
+        _parse_ref_info, _private_index, _snapshot_message, _snapshot_origin,
+        _taken_from, _next_snapshot_number, _read_snapshot_counter,
+        _write_snapshot_counter)
+
+DEFAULT_LIMIT = 8
+
+
+async def _spawn_git(*args, cwd=None, env=None, stderr=asyncio.subprocess.PIPE):
+    """Start a git subprocess with its stdout piped."""
+    if env:
+        env = dict(os.environ, **env)
+    try:
+        return await asyncio.create_subprocess_exec(
+            'git', *args, stdout=asyncio.subprocess.PIPE, stderr=stderr,
+            cwd=cwd, env=env)
+    except FileNotFoundError:
+        raise _not_found(cwd)
+
+
+async def _run_git(semaphore, *args, cwd=None, env=None, check=True):
+    """Run git to completion, returning ``(returncode, stdout)``.
+
+    Raises GitError, with git's error output, if git fails, unless ``check``
+    is False. NotARepository is raised either way.
+    """
+    async with semaphore:
+        proc = await _spawn_git(*args, cwd=cwd, env=env)
+        stdout, stderr = await proc.communicate()
+    if proc.returncode:
+        error = _git_error(stderr)
+        if check or isinstance(error, NotARepository):
+            raise error
+    return proc.returncode, stdout.decode()
+
+
+class AsyncTwitRepo(object):
+    """Twit repository driven by asyncio subprocesses.
+
+    Git processes are started under ``semaphore``, which bounds how many run
+    at once. Pass the same semaphore to several repositories to cap the
+    total; otherwise each repository gets its own, allowing ``limit``.
+    """
+
+    def __init__(self, path, workdir=None, semaphore=None,
+                 limit=DEFAULT_LIMIT):
+        self.path = os.path.abspath(path)
+        self.workdir = workdir or os.path.dirname(self.path)
+        self._semaphore = semaphore
+        self._limit = limit
+        self._refs = _RefStore(self.path)
+        self._commits = _LRUCache()
+        self._empty_tree = None
+
+    @classmethod
+    async def from_path(cls, path, semaphore=None, **kwargs):
+        """Get the repository containing a directory."""
+        semaphore = semaphore or asyncio.Semaphore(
+            kwargs.get('limit', DEFAULT_LIMIT))
+        _, repo_path = await _run_git(semaphore, 'rev-parse', '--git-dir',
+                                      cwd=path)
+        # Bare repositories have no work tree.
+        returncode, workdir = await _run_git(
+            semaphore, 'rev-parse', '--show-toplevel', cwd=path, check=False)
+        return cls(os.path.join(path, repo_path.strip()),
+                   workdir.strip() if returncode == 0 else None,
+                   semaphore=semaphore, **kwargs)
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._limit)
+        return self._semaphore
+
+    async def _git(self, *args, cwd=None, env=None):
+        """Run git, raising GitError if it fails."""
+        _, stdout = await _run_git(self.semaphore, *args,
+                                   cwd=cwd or self.path, env=env)
+        return stdout.rstrip()
+
+    async def _git_check(self, *args, cwd=None):
+        """Run git, returning True if it succeeded."""
+        returncode, _ = await _run_git(self.semaphore, *args,
+                                       cwd=cwd or self.path, check=False)
+        return returncode == 0
+
+    async def _git_records(self, *args, sep='\n', cwd=None):
+        """Yield records from git, like twit._git_iter.
+
+        If git fails, GitError is raised once the records are exhausted.
+        Closing the generator early stops git instead.
+        """
+        splitter = _RecordSplitter(sep)
+        with tempfile.TemporaryFile() as errors:
+            async with self.semaphore:
+                proc = await _spawn_git(*args, cwd=cwd or self.path,
+                                        stderr=errors)
+                finished = False
+                try:
+                    while True:
+                        chunk = await proc.stdout.read(65536)
+                        if not chunk:
+                            break
+                        for record in splitter.feed(chunk):
+                            yield record
+                    for record in splitter.flush():
+                        yield record
+                    finished = True
+                finally:
+                    if not finished and proc.returncode is None:
+                        proc.kill()
+                    await proc.wait()
+            if proc.returncode:
+                errors.seek(0)
+                raise _git_error(errors.read())
+
+    async def rev_parse(self, ref):
+        """Return the oid of the reference, or an empty string if error."""
+        oid = self._refs.rev_parse(ref)
+        if oid is not None:
+            return oid
+        returncode, stdout = await _run_git(
+            self.semaphore, 'rev-parse', '--verify', '-q', ref, cwd=self.path,
+            check=False)
+        return stdout.strip() if returncode == 0 else ''
+
+    async def dirty(self, untracked=True):
+        """Check for modified files, and untracked ones unless disabled."""
+        args = ['status', '-z', '--porcelain']
+        if not untracked:
+            args.append('--untracked-files=no')
+        skip = False
+        records = self._git_records(*args, sep='\0', cwd=self.workdir)
+        try:
+            async for record in records:
+                if skip or len(record) < 2:
+                    skip = False
+                    continue
+                # Renames and copies are followed by the source path.
+                skip = record[0] in 'RC'
+                if record[1] not in (' ', '!'):
+                    return True
+        finally:
+            await records.aclose()
+        return False
+
+    async def snapshots(self, limit=None, since=None):
+        """Return RefInfo records for snapshots, newest first."""
+        infos = []
+        records = self._git_records(*_REF_INFO_ARGS, SNAPSHOT_PREFIX)
+        try:
+            async for record in records:
+                if limit is not None and len(infos) >= limit:
+                    break
+                info = _parse_ref_info(record)
+                if since is not None and info.time < since:
+                    break
+                infos.append(info)
+        finally:
+            await records.aclose()
+        return infos
+
+    async def commit_info(self, ref):
+        """Return info about a given commit."""
+        oid = await self.rev_parse(ref + '^{commit}')
+        if not oid:
+            raise InvalidRef
+        info = self._commits.get(oid)
+        if info is None:
+            _, raw_commit = await _run_git(
+                self.semaphore, 'cat-file', 'commit', oid, cwd=self.path)
+            info = _parse_commit(raw_commit)
+        self._commits.put(oid, info)
+        return info
+
+    async def _worktree_tree(self):
+        """Write a tree of the work tree using a private copy of the index."""
+        with _private_index(self.path) as env:
+            await self._git('add', '--all', '.', env=env, cwd=self.workdir)
+            return await self._git('write-tree', env=env, cwd=self.workdir)
+
+    async def _latest_snapshot(self, index, parent, branch):
+        """Return the snapshot numbered just before ``index`` if it was taken
+        from ``parent`` on ``branch``, like TwitMixin._latest_snapshot."""
+        ref = '{}{}'.format(SNAPSHOT_PREFIX, index - 1)
+        try:
+            cinfo = await self.commit_info(ref)
+        except InvalidRef:
+            return None
+        return (ref, cinfo) if _taken_from(cinfo, parent, branch) else None
+
+    async def save(self):
+        """Save a snapshot of the working directory, unless it matches the
+        previous snapshot and that was taken from the same branch and
+        commit."""
+        tree = await self._worktree_tree()
+        head = self._refs.symbolic_head()
+        branch = head[len('refs/heads/'):] if head else None
+        parent = await self.rev_parse('HEAD')
+        index = _read_snapshot_counter(self._refs.common_path)
+        if index is None:
+            index = _next_snapshot_number(
+                ref for ref, _ in self._refs.items(SNAPSHOT_PREFIX))
+        latest = await self._latest_snapshot(index, parent, branch)
+        if latest is not None and latest[1].tree == tree:
+            return latest[0]
+        args = ['commit-tree', tree, '-m', _snapshot_message(branch)]
+        if parent:
+            args += ['-p', parent]
+        commit = await self._git(*args)
+        if not _RefStore.OID.match(commit):
+            raise GitError(commit)
+        while True:
+            ref = '{}{}'.format(SNAPSHOT_PREFIX, index)
+            if await self._git_check('update-ref', ref, commit,
+                                     '0' * len(commit)):
+                break
+            if not self._refs.resolve(ref):
+                raise GitError("could not create {}".format(ref))
+            index += 1
+        _write_snapshot_counter(self._refs.common_path, index + 1)
+        return ref
+
+    async def empty_tree(self):
+        """Return the oid of the empty tree in this repository."""
+        if self._empty_tree is None:
+            self._empty_tree = await self._git(*_EMPTY_TREE_ARGS)
+        return self._empty_tree
+
+    async def _open_snapshot(self, oid):
+        cinfo = await self.commit_info(oid)
+        parent, branch = _snapshot_origin(cinfo)
+        head = await self.rev_parse('HEAD')
+        await self._git('read-tree', '-m', '-u',
+                        head or await self.empty_tree(), oid, cwd=self.workdir)
+        if parent is None:
+            await self._git('symbolic-ref', 'HEAD',
+                'refs/heads/twit/snapshot/unborn{}'.format(cinfo.time))
+            await self._git('read-tree', '--empty', cwd=self.workdir)
+        else:
+            await self._git('update-ref', '--no-deref', 'HEAD', parent)
+            await self._git('read-tree', '-m', parent, cwd=self.workdir)
+        if branch is not None:
+            branch_commit = await self.rev_parse(branch)
+            if (parent is None and not branch_commit) or \
+                    (parent is not None and branch_commit == parent):
+                await self._git('symbolic-ref', 'HEAD',
+                                'refs/heads/' + branch)
+
+    async def open(self, ref):
+        """Open a branch, commit, or snapshot."""
+        if await self.dirty():
+            raise DirtyWorkTree
+        oid = await self.rev_parse(ref)
+        if not oid:
+            ref = 'refs/heads/' + ref
+            oid = await self.rev_parse(ref)
+            if not oid:
+                raise InvalidRef
+        snapshots = set(oid for _, oid in self._refs.items(SNAPSHOT_PREFIX))
+        if oid in snapshots:
+            await self._open_snapshot(oid)
+        else:
+            await self._git('checkout', '-q', ref, cwd=self.workdir)
@@ -0,0 +1,260 @@
+"""Command line interface for Twit.
+
+Kept out of the twit module so that importing twit does not import click.
+"""
+import io
+import time
+import json
+import datetime
+
+import click
+
+from twit import (InvalidRef, GitProfiler, TwitDaemon, find_repositories,
+        run_batch, stop_daemon, _get_repo)
+
+
+@click.group()
+@click.option('--trace', is_flag=True,
+              help='Print every git call and a summary to stderr.')
+@click.option('--profile', type=click.Path(dir_okay=False),
+              help='Append a JSON summary of git calls to a file.')
+@click.pass_context
+def main(context, trace, profile):
+    """Twit: an easier git frontend.
+
+    For help on a subcommand, run:
+
+        twit help SUBCOMMAND
+
+    """
+    if not (trace or profile):
+        return
+    echo = (lambda line: click.echo(line, err=True)) if trace else None
+    profiler = GitProfiler(echo=echo)
+    profiler.__enter__()
+
+    def report():
+        profiler.__exit__(None, None, None)
+        command = context.invoked_subcommand
+        if trace:
+            click.echo(profiler.describe(command), err=True)
+        if profile:
+            with io.open(profile, 'a', encoding='utf-8') as wfile:
+                wfile.write(u'{}\n'.format(
+                    json.dumps(profiler.summary(command), sort_keys=True)))
+
+    context.call_on_close(report)
+
+
+def batch_options(command):
+    """Add the options for running a command across many repositories."""
+    command = click.option('-j', '--jobs', default=4, show_default=True,
+                           help='Repositories to process in parallel.')(command)
+    command = click.option('--repos', 'repo_list', type=click.File('r'),
+                           help='File listing repository paths, one per line.'
+                           )(command)
+    command = click.option('--all-under', 'root',
+                           type=click.Path(exists=True, file_okay=False),
+                           help='Run on every repository under a directory.'
+                           )(command)
+    return command
+
+
+def _batch_paths(root, repo_list):
+    """Return the repositories selected by the batch options, or None."""
+    if root is None and repo_list is None:
+        return None
+    paths = []
+    if root is not None:
+        paths += find_repositories(root)
+    if repo_list is not None:
+        paths += [line.strip() for line in repo_list
+                  if line.strip() and not line.startswith('#')]
+    return paths
+
+
+def _echo_batch(paths, operation, jobs):
+    """Run a batch operation, streaming each repository's output."""
+    failed = 0
+    for path, lines, error in run_batch(paths, operation, jobs):
+        if error is not None:
+            failed += 1
+            click.echo('{}: error: {}'.format(path, error), err=True)
+            continue
+        for line in lines:
+            click.echo('{}: {}'.format(path, line))
+    if failed:
+        raise click.ClickException('{} of {} repositories failed'.format(
+            failed, len(paths)))
+
+
+@main.command()
+@batch_options
+def save(root, repo_list, jobs):
+    """Take a snapshot of your current work."""
+    paths = _batch_paths(root, repo_list)
+    if paths is not None:
+        _echo_batch(paths, lambda repo: ['saved ' + repo.save()], jobs)
+        return
+    repo = _get_repo()
+    repo.save()
+    click.echo('Snapshot saved.')
+
+
+@main.command()
+@click.argument('revision')
+def open(revision):
+    """Open a snapshot or branch."""
+    repo = _get_repo()
+    with repo.operation():
+        snapshot = None
+        if repo.dirty:
+            snapshot = repo.save()
+            repo.discard_all()
+        try:
+            repo.open(revision)
+        except InvalidRef:
+            click.echo("Invalid revision specified.")
+            if snapshot is not None:
+                repo.open(snapshot)
+
+
+def _snapshot_lines(repo, limit, since):
+    for info in repo.snapshot_infos(limit=limit, since=since):
+        yield '{} at {}'.format(info.oid[:6],
+            datetime.datetime.fromtimestamp(info.time))
+
+
+@main.command()
+@click.option('-n', '--limit', type=int, help='Show at most this many.')
+@click.option('--since', type=click.DateTime(),
+              help='Only show snapshots taken after this date.')
+@batch_options
+def snapshots(limit, since, root, repo_list, jobs):
+    """Show a list of snapshots, newest first."""
+    if since is not None:
+        since = time.mktime(since.timetuple())
+    paths = _batch_paths(root, repo_list)
+    if paths is not None:
+        _echo_batch(paths,
+                    lambda repo: list(_snapshot_lines(repo, limit, since)),
+                    jobs)
+        return
+    repo = _get_repo()
+    for line in _snapshot_lines(repo, limit, since):
+        click.echo(line)
+
+
+@main.command()
+@click.option('--debounce', type=float, default=1.0, show_default=True,
+              help='Seconds without changes before a snapshot is taken.')
+@click.option('--interval', type=float, default=1.0, show_default=True,
+              help='Seconds between scans when polling.')
+@click.option('--poll', is_flag=True,
+              help='Poll for changes even if inotify is available.')
+def watch(debounce, interval, poll):
+    """Take snapshots automatically as files change."""
+    repo = _get_repo()
+
+    def saved(ref):
+        click.echo('Saved {}'.format(ref))
+
+    def failed(error):
+        click.echo('Could not save: {}'.format(error), err=True)
+
+    try:
+        repo.watch(debounce=debounce, interval=interval, poll=poll,
+                   callback=saved, errback=failed)
+    except KeyboardInterrupt:
+        pass
+
+
+@main.command()
+@click.option('--keep-last', type=int, default=0,
+              help='Always keep this many of the newest snapshots.')
+@click.option('--hourly', type=int, default=0,
+              help='Keep one snapshot per hour for this many hours.')
+@click.option('--daily', type=int, default=0,
+              help='Keep one snapshot per day for this many days.')
+@click.option('--weekly', type=int, default=0,
+              help='Keep one snapshot per week for this many weeks.')
+@click.option('--dry-run', is_flag=True,
+              help='Only list the snapshots that would be deleted.')
+@click.option('--gc', 'run_gc', is_flag=True,
+              help='Run git gc after pruning.')
+def prune(keep_last, hourly, daily, weekly, dry_run, run_gc):
+    """Delete old snapshots according to a retention policy."""
+    if not (keep_last or hourly or daily or weekly):
+        raise click.UsageError('Specify at least one retention option.')
+    repo = _get_repo()
+    deleted = repo.prune_snapshots(keep_last=keep_last, hourly=hourly,
+                                   daily=daily, weekly=weekly,
+                                   dry_run=dry_run, gc=run_gc)
+    if dry_run:
+        for ref in deleted:
+            click.echo('Would delete {}'.format(ref))
+    else:
+        click.echo('Pruned {} snapshots.'.format(len(deleted)))
+
+
+@main.command()
+@click.argument('filename', type=click.Path(dir_okay=False))
+@click.option('--since', type=click.Path(exists=True, dir_okay=False),
+              multiple=True,
+              help='Only export snapshots missing from this earlier export '
+                   '(repeatable).')
+def export(filename, since):
+    """Write snapshots to a bundle file."""
+    refs = _get_repo().export_snapshots(filename, since=since)
+    if refs:
+        click.echo('Exported {} snapshots to {}.'.format(len(refs), filename))
+    else:
+        click.echo('No new snapshots to export.')
+
+
+@main.command('import')
+@click.argument('filename', type=click.Path(exists=True, dir_okay=False))
+def import_(filename):
+    """Add the snapshots from a bundle file."""
+    refs = _get_repo().import_snapshots(filename)
+    click.echo('Imported {} snapshots.'.format(len(refs)))
+
+
+@main.command()
+@click.option('--idle-timeout', type=float,
+              help='Exit after this many seconds without a request.')
+@click.option('--stop', is_flag=True,
+              help='Stop the daemon serving this repository.')
+def serve(idle_timeout, stop):
+    """Keep this repository warm in a background server.
+
+    While it runs, `twit save`, `twit open` and `twit snapshots` in this
+    repository are handed to it over a Unix socket.
+    """
+    repo = _get_repo()
+    if stop:
+        if not stop_daemon(repo.path):
+            click.echo('No daemon is running.')
+        return
+    daemon = TwitDaemon(repo, idle_timeout)
+    click.echo('Serving {}'.format(daemon.path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+@main.command('help')
+@click.argument('subcommand', required=False)
+@click.pass_context
+def help_(context, subcommand):
+    """Print help for a subcommand."""
+    if subcommand is None:
+        click.echo(main.get_help(context))
+    else:
+        if subcommand not in main.commands:
+            click.echo("Command '{}' does not exist.\n".format(subcommand))
+            click.echo(main.get_help(context))
+            context.exit(1)
+        command = main.commands[subcommand]
+        click.echo(command.get_help(context))